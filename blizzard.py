@@ -1,6 +1,9 @@
 import ipdb
+import os
+from multiprocessing import Pool
 import numpy as np
 import scipy.signal
+import tables
 import theano
 import theano.tensor as T
 
@@ -9,7 +12,8 @@ from prep import SequentialPrepMixin
 from util import segment_axis, totuple
 from util import complex_to_real
 
-from grep_blizzard_hdf5 import fetch_blizzard, fetch_blizzard_tbptt
+from grep_blizzard_hdf5 import fetch_blizzard, fetch_blizzard_tbptt, sum_blizzard
+from grep_blizzard_hdf5 import ChunkCache
 
 
 
@@ -30,6 +34,8 @@ class Blizzard(TemporalSeries, SequentialPrepMixin):
                  frame_size=200,
                  overlap=0,
                  file_name="full_blizzard",
+                 cache_bytes=0,
+                 spec_cache=0,
                  **kwargs):
 
         self.X_mean = X_mean
@@ -41,6 +47,8 @@ class Blizzard(TemporalSeries, SequentialPrepMixin):
         self.frame_size = frame_size
         self.file_name = file_name
         self.overlap = overlap
+        self.cache_bytes = cache_bytes
+        self.spec_cache = spec_cache
 
         if self.use_window or self.use_spec:
             if self.use_spec:
@@ -62,38 +70,138 @@ class Blizzard(TemporalSeries, SequentialPrepMixin):
         X = fetch_blizzard(data_path, self.shuffle, self.seq_len, self.file_name+'.h5')
 
         if (self.X_mean is None or self.X_std is None) and not self.use_spec:
-            prev_mean = None
-            prev_var = None
-            n_seen = 0
-            n_inter = 10000
-            range_end = np.int(np.ceil(len(X) / float(n_inter)))
-
-            for i in xrange(range_end):
-                n_seen += 1
-                i_start = i*n_inter
-                i_end = min((i+1)*n_inter, len(X))
-
-                if prev_mean is None:
-                    prev_mean = X[i_start:i_end].mean()
-                    prev_var = 0.
-                else:
-                    curr_mean = prev_mean +\
-                        (X[i_start:i_end] - prev_mean).mean() / n_seen
-                    curr_var = prev_var +\
-                        ((X[i_start:i_end] - prev_mean) *
-                         (X[i_start:i_end] - curr_mean)).mean()
-                    prev_mean = curr_mean
-                    prev_var = curr_var
-
-                print "[%d / %d]" % (i+1, range_end)
-
-            save_file_name = self.file_name + '_normal.npz'
-            self.X_mean = prev_mean
-            self.X_std = np.sqrt(prev_var / n_seen)
-            np.savez(data_path + save_file_name, X_mean=self.X_mean, X_std=self.X_std)
+            self.X_mean, self.X_std = self.normal_params(X, data_path)
 
+        return self.cached(self.spec_features(X, data_path))
+
+    def cached(self, X):
+        # random access goes through an LRU cache of inflated chunks
+        if self.cache_bytes > 0:
+            return ChunkCache(X, self.cache_bytes)
         return X
 
+    def spec_features(self, X, data_path, n_jobs=None, rows_per_task=256):
+        """
+        With use_spec and spec_cache, the spectral features of every row of
+        X, computed once and stored next to it
+        Parameters
+        ----------
+        X         : the EArray returned by fetch_blizzard(_tbptt)
+        data_path : string
+        n_jobs    : integer
+            Size of the process pool computing row ranges in parallel
+        Notes
+        -----
+        Features are written to `file_name`_spec_fs`frame_size`_ov`overlap`.h5,
+        rebuilt when the size or mtime of the raw file, or its TBPTT layout
+        (`batch_size` and `file_batches` attributes, copied over), changes.
+        """
+        if not (self.use_spec and self.spec_cache):
+            return X
+
+        raw_path = X._v_file.filename
+        stat = os.stat(raw_path)
+        layout = dict((name, getattr(X.attrs, name)) for name in ('batch_size', 'file_batches')
+                      if name in X.attrs)
+        key = np.concatenate([[stat.st_size, stat.st_mtime, layout.get('batch_size', -1)],
+                              layout.get('file_batches', [])]).astype('float64')
+        spec_path = data_path + '%s_spec_fs%d_ov%d.h5' % (self.file_name,
+                                                          self.frame_size,
+                                                          self.overlap)
+        if os.path.exists(spec_path):
+            spec_file = tables.open_file(spec_path, mode='r')
+            if np.array_equal(spec_file.root.data.attrs.source_key, key):
+                return spec_file.root.data
+            spec_file.close()
+
+        sample = self.spec_rows(X, 0, 1)
+        tasks = [(raw_path, i, min(i + rows_per_task, len(X)),
+                  self.frame_size, self.overlap, self.window)
+                 for i in xrange(0, len(X), rows_per_task)]
+
+        # write under a temporary name, a partial file is never picked up
+        tmp_path = spec_path + '.tmp'
+        pool = Pool(n_jobs)
+        spec_file = tables.open_file(tmp_path, mode='w')
+        try:
+            data = spec_file.create_earray(spec_file.root, 'data',
+                                           tables.Atom.from_dtype(sample.dtype),
+                                           shape=(0,) + sample.shape[1:],
+                                           filters=tables.Filters(complevel=5, complib='blosc'),
+                                           expectedrows=len(X))
+            for i, rows in enumerate(pool.imap(_spec_task, tasks)):
+                data.append(rows)
+                print "[%d / %d]" % (i + 1, len(tasks))
+            for name, value in layout.items():
+                setattr(data.attrs, name, value)
+            data.attrs.source_key = key
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        finally:
+            spec_file.close()
+        pool.close()
+        pool.join()
+        os.rename(tmp_path, spec_path)
+
+        return tables.open_file(spec_path, mode='r').root.data
+
+    def spec_rows(self, X, start, end):
+        """ Spectral features of rows [start, end) of the raw audio X. """
+        batch = np.array(X[start:end], dtype=theano.config.floatX)
+        return log_spectra(batch, self.frame_size, self.overlap, self.window,
+                           out=self.window_buffer(batch))
+
+    def batch_starts(self, batch_size, start=0, end=None, rng=np.random):
+        """
+        Shuffled first rows of the batches of [start, end). Cache blocks
+        are shuffled, then the batches within each block, so that nearby
+        batches share their decompressed chunks.
+        """
+        end = len(self.data) if end is None else end
+        starts = np.arange(start, end, batch_size)
+        if len(starts) == 0:
+            return starts
+        block_rows = getattr(self.data, 'block_rows', self.data.chunkshape[0])
+        block = starts // block_rows
+        keys = rng.permutation(block.max() + 1)[block]
+        return starts[np.lexsort((rng.rand(len(starts)), keys))]
+
+    def worker_init(self):
+        # HDF5 handles are not fork safe, every worker opens its own
+        self.data = self.cached(tables.open_file(self.data._v_file.filename,
+                                                 mode='r').root.data)
+
+    def normal_params(self, X, data_path, start=0, stop=None):
+        """
+        Exact mean and standard deviation of the samples of rows [start, stop)
+        Parameters
+        ----------
+        X         : the EArray returned by fetch_blizzard(_tbptt)
+        data_path : string
+            The statistics are cached in `data_path``file_name`_normal.npz,
+            keyed by the size and mtime of the HDF5 file and the row range
+        """
+        stop = len(X) if stop is None else min(stop, len(X))
+        hdf5_path = X._v_file.filename
+        stat = os.stat(hdf5_path)
+        key = np.array([stat.st_size, stat.st_mtime, start, stop], dtype='float64')
+        save_path = data_path + self.file_name + '_normal.npz'
+
+        if os.path.exists(save_path):
+            normal_params = np.load(save_path)
+            if 'key' in normal_params and np.array_equal(normal_params['key'], key):
+                return normal_params['X_mean'], normal_params['X_std']
+
+        n, x_sum, x_sqr = sum_blizzard(hdf5_path, start, stop)
+        X_mean = x_sum / float(n)
+        # n * sum(x^2) - sum(x)^2 is computed on integers, no cancellation
+        X_std = np.sqrt((n * x_sqr - x_sum * x_sum) / float(n) ** 2)
+        np.savez(save_path, X_mean=X_mean, X_std=X_std, key=key)
+
+        return X_mean, X_std
+
     def theano_vars(self):
         return T.tensor3('x', dtype=theano.config.floatX)
 
@@ -102,44 +210,59 @@ class Blizzard(TemporalSeries, SequentialPrepMixin):
 
     def slices(self, start, end):
 
-        batch = np.array(self.data[start:end], dtype=theano.config.floatX)
-
         if self.use_spec:
-            batch = self.apply_fft(batch)
-            batch = self.log_magnitude(batch)
-            batch = self.concatenate(batch)
+            if self.spec_cache:
+                # features precomputed by spec_features
+                batch = np.array(self.data[start:end], dtype=theano.config.floatX)
+            else:
+                batch = self.spec_rows(self.data, start, end)
         else:
+            batch = np.array(self.data[start:end], dtype=theano.config.floatX)
             batch -= self.X_mean
             batch /= self.X_std
             if self.use_window:
                 batch = self.apply_window(batch)
             else:
-                batch = np.asarray([segment_axis(x, self.frame_size, 0) for x in batch])
+                batch = self.frames(batch, 0)
 
         batch = batch.transpose(1, 0, 2)
 
         return totuple(batch)
 
-    def apply_window(self, batch):
+    def frames(self, batch, overlap, end='cut'):
+        """
+        Frames of every example of a (batch, seq_len) block, as a single
+        strided (batch, n_frames, frame_size) view (a copy for end='pad')
+        """
+        return segment_axis(batch, self.frame_size, overlap, axis=1, end=end)
+
+    def apply_window(self, batch, out=None):
 
-        batch = np.array([self.window * segment_axis(x, self.frame_size,
-                                                     self.overlap, end='pad')
-                          for x in batch])
+        frames = self.frames(batch, self.overlap, end='pad')
+        batch = np.multiply(frames, self.window, out=out)
 
         return batch
 
+    def window_buffer(self, batch):
+        """ Buffer for the windowed frames of `batch`, reused across batches. """
+        # the windowed frames are only an intermediate
+        shape = self.frames(batch[:1], self.overlap, end='pad').shape
+        shape = (len(batch),) + shape[1:]
+        if getattr(self, '_window_buffer', None) is None or \
+                self._window_buffer.shape != shape:
+            self._window_buffer = np.empty(shape, dtype=theano.config.floatX)
+        return self._window_buffer
+
     def apply_fft(self, batch):
 
-        batch = np.array([self.numpy_rfft(self.window *
-                                          segment_axis(x, self.frame_size,
-                                                       self.overlap, end='pad'))
-                          for x in batch])
+        batch = self.apply_window(batch, out=self.window_buffer(batch))
+        batch = self.numpy_rfft(batch)
 
         return batch
 
     def apply_ifft(self, batch):
 
-        batch = np.array([self.numpy_irfft(example) for example in batch])
+        batch = self.numpy_irfft(np.asarray(batch))
 
         return batch
 
@@ -187,14 +310,7 @@ class Blizzard(TemporalSeries, SequentialPrepMixin):
 
     def concatenate(self, batch):
 
-        batch_shape = batch.shape
-        batch_reshaped = batch.reshape((batch_shape[0] *
-                                        batch_shape[1],
-                                        batch_shape[2]))
-        batch_concatenated = complex_to_real(batch_reshaped)
-        new_batch = batch_concatenated.reshape((batch_shape[0],
-                                                batch_shape[1],
-                                                batch_concatenated.shape[-1]))
+        new_batch = complex_to_real(batch)
         new_batch = new_batch.astype(theano.config.floatX)
 
         return new_batch
@@ -225,42 +341,101 @@ class Blizzard_tbptt(Blizzard):
                                  file_name=self.file_name+'.h5')
 
         if (self.X_mean is None or self.X_std is None) and not self.use_spec:
-            prev_mean = None
-            prev_var = None
-            n_seen = 0
-            n_inter = 10000
-            range_start = self.range_start
-
-            if self.range_end is not None:
-                range_end = np.int(np.ceil(self.range_end / float(n_inter)))
-            else:
-                range_end = np.int(np.ceil(len(X) / float(n_inter)))
-
-            for i in xrange(range_start, range_end):
-                n_seen += 1
-                i_start = i*n_inter
-                i_end = min((i+1)*n_inter, len(X))
-
-                if prev_mean is None:
-                    prev_mean = X[i_start:i_end].mean()
-                    prev_var = 0.
-                else:
-                    curr_mean = prev_mean +\
-                        (X[i_start:i_end] - prev_mean).mean() / n_seen
-                    curr_var = prev_var +\
-                        ((X[i_start:i_end] - prev_mean) *\
-                         (X[i_start:i_end] - curr_mean)).mean()
-                    prev_mean = curr_mean
-                    prev_var = curr_var
-
-                print "[%d / %d]" % (i+1, range_end)
-
-            save_file_name = self.file_name + '_normal.npz'
-            self.X_mean = prev_mean
-            self.X_std = np.sqrt(prev_var / n_seen)
-            np.savez(data_path + save_file_name, X_mean=self.X_mean, X_std=self.X_std)
+            self.X_mean, self.X_std = self.normal_params(X, data_path,
+                                                         self.range_start,
+                                                         self.range_end)
 
-        return X
+        return self.cached(self.spec_features(X, data_path))
+
+
+def log_spectra(batch, frame_size, overlap, window, out=None):
+    """
+    Log-magnitude spectra of the windowed frames of a (batch, seq_len)
+    block, real and imaginary parts concatenated, as computed by
+    Blizzard.apply_fft, log_magnitude and concatenate. `out` is an optional
+    buffer for the windowed frames, see Blizzard.window_buffer.
+    """
+    frames = segment_axis(batch, frame_size, overlap, axis=1, end='pad')
+    spectra = np.fft.rfft(np.multiply(frames, window, out=out), axis=-1)
+    spectra = spectra.astype(np.result_type(frames.dtype, np.complex64))
+    mag, phase = R2P(spectra)
+    spectra = P2R(np.log10(mag + 1.), phase)
+    return complex_to_real(spectra).astype(theano.config.floatX)
+
+
+def _spec_task(args):
+    """ Features of rows [start, end) of the raw file, see Blizzard.spec_features. """
+    raw_path, start, end, frame_size, overlap, window = args
+    raw_file = tables.open_file(raw_path, mode='r')
+    try:
+        batch = np.array(raw_file.root.data[start:end], dtype=theano.config.floatX)
+    finally:
+        raw_file.close()
+    return log_spectra(batch, frame_size, overlap, window)
+
+
+class TBPTTIterator(object):
+    """
+    Truncated BPTT iterator over the streams of a Blizzard_tbptt dataset
+    Parameters
+    ----------
+    data        : Blizzard_tbptt
+    start       : integer
+    end         : integer
+        Row range, rounded to whole segments of `data.batch_size` rows
+    reset_every : integer
+        Also start the streams over every `reset_every` segments
+    Notes
+    -----
+    Yields (x, y, x_mask, reset) for consecutive segments of the same
+    `data.batch_size` streams. x holds the frames of a segment, shaped
+    (n_frames, batch_size, frame_size), and y is x shifted by one frame,
+    its last frame being the first frame of the next segment. When
+    `reset` is True the recurrent state must be zeroed before the
+    segment. The last step is masked out when the next segment starts
+    other utterances (a new source file or the end of the range).
+    """
+    def __init__(self, data, start=0, end=None, reset_every=None):
+        self.data = data
+        self.batch_size = data.batch_size
+        end = len(data.data) if end is None else min(end, len(data.data))
+        self.start = -(-start // self.batch_size) * self.batch_size
+        self.end = end - end % self.batch_size
+        self.reset_every = reset_every
+        self.name = data.name
+
+        attrs = data.data.attrs
+        if 'batch_size' in attrs and attrs.batch_size != self.batch_size:
+            raise ValueError("%s holds %d streams, got batch_size=%d."
+                             % (data.file_name, attrs.batch_size, self.batch_size))
+        file_batches = attrs.file_batches if 'file_batches' in attrs else []
+        self.file_starts = set(self.batch_size *
+                               np.cumsum(np.concatenate([[0], file_batches])).astype('int64'))
+
+    def __iter__(self):
+        starts = range(self.start, self.end, self.batch_size)
+        batches = self.data.iter_slices([(idx, idx + self.batch_size) for idx in starts])
+        prev = None
+        for k, batch in enumerate(batches):
+            boundary = k == 0 or starts[k] in self.file_starts
+            reset = boundary or bool(self.reset_every and k % self.reset_every == 0)
+            frames = batch[0]
+            if prev is not None:
+                yield self._segment(prev[0], prev[1], frames, boundary)
+            prev = (frames, reset)
+        if prev is not None:
+            yield self._segment(prev[0], prev[1], None, True)
+
+    def _segment(self, x, reset, next_x, boundary):
+        y = np.empty_like(x)
+        y[:-1] = x[1:]
+        x_mask = np.ones(x.shape[:2], dtype='float32')
+        if boundary:
+            y[-1] = 0.
+            x_mask[-1] = 0.
+        else:
+            y[-1] = next_x[0]
+        return x, y, x_mask, reset
 
 
 def P2R(magnitude, phase):
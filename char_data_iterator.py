@@ -1,70 +1,91 @@
 #import cPickle as pkl
-import gzip
 import numpy
 
+from line_index import LineIndex
+
+
 class TextIterator:
     def __init__(self, source,
                  source_dict,
                  batch_size=128,
                  maxlen=100,
                  minlen=0,
-                 n_words_source=-1):
-        if source.endswith('.gz'):
-            self.source = gzip.open(source, 'r')
-        else:
-            self.source = open(source, 'r')
+                 n_words_source=-1,
+                 shuffle=False,
+                 k=1,
+                 seed=1234):
+        # plain or gzip, lines are indexed once and cached next to the source
+        self.source = LineIndex(source)
 
         a = numpy.load(source_dict)
         #i2w = a['arr_0'][0]
         w2i = a['arr_0'][1]
         self.source_dict = w2i
+        self.lut = self._build_lut(w2i, n_words_source)
         self.batch_size = batch_size
         self.maxlen = maxlen
         self.minlen = 10
         self.n_words_source = n_words_source
 
-        self.end_of_data = False
+        # shuffle lines every epoch, sort k batches by length before cutting
+        self.shuffle = shuffle
+        self.k = k
+        self.rng = numpy.random.RandomState(seed)
+
+        self.reset()
+
+    @staticmethod
+    def _build_lut(w2i, n_words_source):
+        """ 256-entry byte -> id table, unknown (and pruned) bytes map to 1. """
+        lut = numpy.ones(256, dtype='int64')
+        for w, i in w2i.items():
+            if len(w) == 1 and ord(w) < 256:
+                lut[ord(w)] = i
+        if n_words_source > 0:
+            lut[lut >= n_words_source] = 1
+        return lut
 
     def __iter__(self):
         return self
 
     def reset(self):
-        self.source.seek(0)
-
-    def next(self):
-        if self.end_of_data:
-            self.end_of_data = False
-            self.reset()
-            raise StopIteration
+        if self.shuffle:
+            self.order = self.source.permutation(self.rng)
+        else:
+            self.order = numpy.arange(len(self.source))
+        self.pos = 0
+        self.batches = []
 
+    def _fill(self):
         source = []
+        n_ahead = self.k * self.batch_size
+
+        while len(source) < n_ahead and self.pos < len(self.order):
+            indices = self.order[self.pos:self.pos + n_ahead - len(source)]
+            self.pos += len(indices)
+            lines = [ss.strip().lower() for ss in self.source.read_lines(indices)]
+            lines = [ss for ss in lines
+                     if self.minlen <= len(ss) < self.maxlen]
+            if not lines:
+                continue
+
+            # map the whole block at once, then split back into lines
+            ids = numpy.take(self.lut, numpy.frombuffer(b''.join(lines),
+                                                        dtype=numpy.uint8))
+            ends = numpy.cumsum([len(ss) for ss in lines])
+            source.extend(numpy.split(ids, ends[:-1]))
+
+        if self.k > 1:
+            source.sort(key=len)
+        self.batches = [source[i:i + self.batch_size]
+                        for i in range(0, len(source), self.batch_size)]
+
+    def next(self):
+        if not self.batches:
+            self._fill()
 
-        try:
-            while True:
-                ss = self.source.readline()
-                if ss == "":
-                    raise IOError
-                #ss = ss.lower()
-                ss = ss.strip().lower()
-                ss = list(ss)
-                ss = [self.source_dict[w] if w in self.source_dict else 1
-                      for w in ss]
-                if self.n_words_source > 0:
-                    ss = [w if w < self.n_words_source else 1 for w in ss]
-
-                if len(ss) >= self.maxlen or len(ss) < self.minlen:
-                    continue
-
-                source.append(ss)
-
-                if len(source) >= self.batch_size:
-                    break
-        except IOError:
-            self.end_of_data = True
-
-        if len(source) <= 0:
-            self.end_of_data = False
+        if not self.batches:
             self.reset()
             raise StopIteration
 
-        return source
+        return self.batches.pop(0)
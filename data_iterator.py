@@ -1,5 +1,7 @@
 import cPickle as pkl
-import gzip
+import numpy
+
+from line_index import LineIndex
 
 
 class TextIterator:
@@ -7,11 +9,12 @@ class TextIterator:
                  source_dict,
                  batch_size=128,
                  maxlen=100,
-                 n_words_source=-1):
-        if source.endswith('.gz'):
-            self.source = gzip.open(source, 'r')
-        else:
-            self.source = open(source, 'r')
+                 n_words_source=-1,
+                 shuffle=False,
+                 k=1,
+                 seed=1234):
+        # plain or gzip, lines are indexed once and cached next to the source
+        self.source = LineIndex(source)
         with open(source_dict, 'rb') as f:
             self.source_dict = pkl.load(f)
 
@@ -20,29 +23,33 @@ class TextIterator:
 
         self.n_words_source = n_words_source
 
-        self.end_of_data = False
+        # shuffle lines every epoch, sort k batches by length before cutting
+        self.shuffle = shuffle
+        self.k = k
+        self.rng = numpy.random.RandomState(seed)
+
+        self.reset()
 
     def __iter__(self):
         return self
 
     def reset(self):
-        self.source.seek(0)
-
-    def next(self):
-        if self.end_of_data:
-            self.end_of_data = False
-            self.reset()
-            raise StopIteration
+        if self.shuffle:
+            self.order = self.source.permutation(self.rng)
+        else:
+            self.order = numpy.arange(len(self.source))
+        self.pos = 0
+        self.batches = []
 
+    def _fill(self):
         source = []
+        n_ahead = self.k * self.batch_size
 
-        try:
-
-            # actual work here
-            while True:
-                ss = self.source.readline()
-                if ss == "":
-                    raise IOError
+        # actual work here
+        while len(source) < n_ahead and self.pos < len(self.order):
+            indices = self.order[self.pos:self.pos + n_ahead - len(source)]
+            self.pos += len(indices)
+            for ss in self.source.read_lines(indices):
                 ss = ss.strip().split()
                 ss = [self.source_dict[w] if w in self.source_dict else 1
                       for w in ss]
@@ -54,14 +61,17 @@ class TextIterator:
 
                 source.append(ss)
 
-                if len(source) >= self.batch_size:
-                    break
-        except IOError:
-            self.end_of_data = True
+        if self.k > 1:
+            source.sort(key=len)
+        self.batches = [source[i:i + self.batch_size]
+                        for i in range(0, len(source), self.batch_size)]
+
+    def next(self):
+        if not self.batches:
+            self._fill()
 
-        if len(source) <= 0:
-            self.end_of_data = False
+        if not self.batches:
             self.reset()
             raise StopIteration
 
-        return source
+        return self.batches.pop(0)
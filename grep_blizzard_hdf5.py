@@ -4,151 +4,345 @@ import os
 import numpy as np
 import tables
 import fnmatch
-
-from util import segment_axis
+from collections import OrderedDict, deque
+from multiprocessing import Pool, cpu_count
 
 
 class _blizzardEArray(tables.EArray):
     pass
 
 
-def fetch_blizzard(data_path, shuffle=0, sz=32000, file_name="full_blizzard.h5"):
+def _find_data_files(data_path):
+    data_matches = []
+
+    for root, dir_names, file_names in os.walk(data_path):
+        for filename in fnmatch.filter(file_names, 'data_*.npy'):
+            data_matches.append(os.path.join(root, filename))
+
+    # sort in proper order
+    return sorted(data_matches,
+                  key=lambda x: int(x.split("/")[-1].split("_")[-1][0]))
+
+
+def _segment_file(args):
+    """
+    Cut every utterance of a `data_*.npy` file into zero-padded segments
+    Parameters
+    ----------
+    args : tuple (path, sz, seed)
+        `seed` is None to keep the file order, else the seed of the
+        permutation of its utterances
+    Returns
+    -------
+    block : (n_segments, sz) int16 array
+    """
+    f, sz, seed = args
+    # Array of arrays, ragged
+    d = np.load(f)
+
+    if seed is not None:
+        rnd_idx = np.random.RandomState(seed).permutation(len(d))
+        d = d[rnd_idx]
+
+    d = [di[:, 0] if len(di.shape) > 1 else di for di in d]
+    n_segments = [-(-len(di) // sz) for di in d]
+
+    block = np.zeros((sum(n_segments), sz), dtype='int16')
+    flat = block.reshape(-1)
+    start = 0
+    for di, n in zip(d, n_segments):
+        flat[start:start + len(di)] = di
+        start += n * sz
+    return block
+
+
+def _append_aligned(data, blocks, rows_per_append):
+    """ Append `blocks` to the EArray `data` in multiples of `rows_per_append`. """
+    pending = []
+    n_pending = 0
+    for block in blocks:
+        pending.append(block)
+        n_pending += len(block)
+        if n_pending >= rows_per_append:
+            buf = np.concatenate(pending)
+            n = len(buf) - len(buf) % rows_per_append
+            data.append(buf[:n])
+            pending = [buf[n:]]
+            n_pending = len(buf) - n
+    if n_pending:
+        data.append(np.concatenate(pending))
+
+
+def _rows_per_append(data, nbytes=2**26):
+    """ Whole EArray chunks adding up to about `nbytes`. """
+    chunk_rows = data.chunkshape[0]
+    row_bytes = data.rowsize
+    return chunk_rows * max(1, nbytes // (row_bytes * chunk_rows))
+
+
+def _imap_bounded(pool, func, tasks, n_in_flight):
+    """
+    Ordered results of `func` over `tasks`, like pool.imap, but with at
+    most `n_in_flight` tasks submitted and not yet consumed, so that a slow
+    consumer does not let the results pile up in memory.
+    """
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= n_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def _log_blocks(blocks, data_matches):
+    for f, block in zip(data_matches, blocks):
+        print("Read file %s: %i segments" % (f, len(block)))
+        yield block
+
+
+def fetch_blizzard(data_path, shuffle=0, sz=32000, file_name="full_blizzard.h5",
+                   n_jobs=None):
 
     hdf5_path = os.path.join(data_path, file_name)
 
     if not os.path.exists(hdf5_path):
-        data_matches = []
-
-        for root, dir_names, file_names in os.walk(data_path):
-            for filename in fnmatch.filter(file_names, 'data_*.npy'):
-                data_matches.append(os.path.join(root, filename))
+        data_matches = _find_data_files(data_path)
 
-        # sort in proper order
-        data_matches = sorted(data_matches,
-                              key=lambda x: int(
-                                  x.split("/")[-1].split("_")[-1][0]))
+        # one seed per file, drawn here so that np.random.seed still applies
+        if shuffle:
+            seeds = np.random.randint(2**31 - 1, size=len(data_matches))
+        else:
+            seeds = [None] * len(data_matches)
 
         # setup tables
         compression_filter = tables.Filters(complevel=5, complib='blosc')
-<<<<<<< HEAD
-        hdf5_file = tables.openFile(hdf5_path, mode='w')
-=======
         hdf5_file = tables.open_file(hdf5_path, mode='w')
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
-        data = hdf5_file.createEArray(hdf5_file.root, 'data',
-                                      tables.Int16Atom(),
-                                      shape=(0, sz),
-                                      filters=compression_filter,)
-
-        for n, f in enumerate(data_matches):
-            print("Reading file %s" % (f))
-
-            with open(f) as fp:
-                # Array of arrays, ragged
-                d = np.load(fp)
-
-                if shuffle:
-                    rnd_idx = np.random.permutation(len(d))
-                    d = d[rnd_idx]
-
-                for n, di in enumerate(d):
-                    print("Processing line %i of %i" % (n+1, len(d)))
-
-                    if len(di.shape) > 1:
-                        di = di[:, 0]
-
-                    e = [r for r in range(0, len(di), sz)]
-                    e.append(None)
-                    starts = e[:-1]
-                    stops = e[1:]
-                    endpoints = zip(starts, stops)
-
-                    for i, j in endpoints:
-                        di_new = di[i:j]
-
-                        # zero pad
-                        if len(di_new) < sz:
-                            di_large = np.zeros((sz,), dtype='int16')
-                            di_large[:len(di_new)] = di_new
-                            di_new = di_large
-
-                        data.append(di_new[None])
+        data = hdf5_file.create_earray(hdf5_file.root, 'data',
+                                       tables.Int16Atom(),
+                                       shape=(0, sz),
+                                       filters=compression_filter,)
+
+        # files are segmented in the pool, the blocks are written here in order
+        pool = Pool(n_jobs)
+        try:
+            blocks = _imap_bounded(pool, _segment_file,
+                                   [(f, sz, seed) for f, seed in zip(data_matches, seeds)],
+                                   n_jobs or cpu_count())
+            _append_aligned(data, _log_blocks(blocks, data_matches),
+                            _rows_per_append(data))
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
 
         hdf5_file.close()
 
-<<<<<<< HEAD
-    hdf5_file = tables.openFile(hdf5_path, mode='r')
-=======
     hdf5_file = tables.open_file(hdf5_path, mode='r')
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
 
     return hdf5_file.root.data
 
 
+def _stitch_file(f, batch_size):
+    """
+    Concatenate the utterances of a `data_*.npy` file and cut the result
+    into `batch_size` streams of equal length, dropping the remainder
+    Returns
+    -------
+    streams : (batch_size, len(all utterances) // batch_size) array
+    """
+    # Array of arrays, ragged
+    d = np.load(f)
+    d = [d[0]] + [di[:, 0] if len(di.shape) > 1 else di for di in d[1:]]
+
+    # first pass: sizes only, then every sample is copied once
+    chunk_size = sum(len(di) for di in d) // batch_size
+    if chunk_size <= 0:
+        raise ValueError("%s holds fewer than batch_size=%d samples"
+                         % (f, batch_size))
+    streams = np.empty((batch_size, chunk_size), dtype=np.result_type(*d))
+    flat = streams.reshape(-1)
+    start = 0
+    for di in d:
+        di = di[:len(flat) - start]
+        flat[start:start + len(di)] = di
+        start += len(di)
+        if start == len(flat):
+            break
+    return streams
+
+
 def fetch_blizzard_tbptt(data_path, sz=8000, batch_size=100, file_name="blizzard_tbptt.h5"):
 
     hdf5_path = os.path.join(data_path, file_name)
 
     if not os.path.exists(hdf5_path):
-        data_matches = []
-
-        for root, dir_names, file_names in os.walk(data_path):
-            for filename in fnmatch.filter(file_names, 'data_*.npy'):
-                data_matches.append(os.path.join(root, filename))
-
-        # sort in proper order
-        data_matches = sorted(data_matches,
-                              key=lambda x: int(
-                                  x.split("/")[-1].split("_")[-1][0]))
+        data_matches = _find_data_files(data_path)
 
         # setup tables
         compression_filter = tables.Filters(complevel=5, complib='blosc')
-<<<<<<< HEAD
-        hdf5_file = tables.openFile(hdf5_path, mode='w')
-=======
         hdf5_file = tables.open_file(hdf5_path, mode='w')
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
-        data = hdf5_file.createEArray(hdf5_file.root, 'data',
-                                      tables.Int16Atom(),
-                                      shape=(0, sz),
-                                      filters=compression_filter,)
+        data = hdf5_file.create_earray(hdf5_file.root, 'data',
+                                       tables.Int16Atom(),
+                                       shape=(0, sz),
+                                       filters=compression_filter,)
 
+        file_batches = []
         for n, f in enumerate(data_matches):
-            print("Reading file %s" % (f))
-
-            with open(f) as fp:
-                # Array of arrays, ragged
-                d = np.load(fp)
-                large_d = d[0]
-
-                for i in xrange(1, len(d)):
-                    print("Processing line %i of %i" % (i+1, len(d)))
-                    di = d[i]
-
-                    if len(di.shape) > 1:
-                        di = di[:, 0]
-
-                    large_d = np.concatenate([large_d, di])
+            seg_d = _stitch_file(f, batch_size)
+            num_batch = (seg_d.shape[-1] - 1) // sz
+            print("Read file %s: %i batches" % (f, num_batch))
+
+            # row j of segment i continues row j of segment i - 1
+            for i in range(num_batch):
+                data.append(seg_d[:, i*sz:(i+1)*sz])
+            file_batches.append(num_batch)
+
+        # streams start over at every file, see blizzard.TBPTTIterator
+        data.attrs.batch_size = batch_size
+        data.attrs.file_batches = np.array(file_batches, dtype='int64')
+        hdf5_file.close()
 
-                chunk_size = int(np.float(len(large_d) / batch_size))
-                seg_d = segment_axis(large_d, chunk_size, 0)
-                num_batch = int(np.float((seg_d.shape[-1] - 1)/float(sz)))
+    hdf5_file = tables.open_file(hdf5_path, mode='r')
 
-                for i in range(num_batch):
-                    batch = seg_d[:, i*sz:(i+1)*sz]
+    return hdf5_file.root.data
 
-                    for j in range(batch_size):
-                        data.append(batch[j][None])
 
+def _sum_rows(args):
+    """ Exact (count, sum, sum of squares) of rows [start, stop) of /data. """
+    hdf5_path, start, stop = args
+    hdf5_file = tables.open_file(hdf5_path, mode='r')
+    try:
+        x = hdf5_file.root.data[start:stop].astype('int64')
+    finally:
         hdf5_file.close()
-
-<<<<<<< HEAD
-    hdf5_file = tables.openFile(hdf5_path, mode='r')
-=======
+    return x.size, int(x.sum()), int(np.dot(x.ravel(), x.ravel()))
+
+
+def sum_blizzard(hdf5_path, start=0, stop=None, n_jobs=None, nbytes=2**24):
+    """
+    Count, sum and sum of squares of the samples of rows [start, stop)
+    Parameters
+    ----------
+    hdf5_path : string
+        File written by fetch_blizzard or fetch_blizzard_tbptt
+    n_jobs    : integer
+        Size of the process pool, every HDF5 chunk is read by one worker only
+    nbytes    : integer
+        Approximate number of bytes read by a worker at a time
+    Notes
+    -----
+    The sums are Python integers, hence exact.
+    """
     hdf5_file = tables.open_file(hdf5_path, mode='r')
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
-
-    return hdf5_file.root.data
+    data = hdf5_file.root.data
+    stop = len(data) if stop is None else min(stop, len(data))
+    step = _rows_per_append(data, nbytes)
+    chunk_rows = data.chunkshape[0]
+    hdf5_file.close()
+
+    # cut on chunk boundaries so that no chunk is inflated twice
+    bounds = [start] + range(-(-start // chunk_rows) * chunk_rows, stop, step) + [stop]
+    tasks = [(hdf5_path, i, j) for i, j in zip(bounds[:-1], bounds[1:]) if j > i]
+
+    pool = Pool(n_jobs)
+    try:
+        n, s, ss = 0, 0, 0
+        for i, (n_i, s_i, ss_i) in enumerate(pool.imap_unordered(_sum_rows, tasks)):
+            n, s, ss = n + n_i, s + s_i, ss + ss_i
+            print("[%d / %d]" % (i + 1, len(tasks)))
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    return n, s, ss
+
+
+class ChunkCache(object):
+    """
+    LRU cache of decompressed row blocks in front of an EArray
+    Parameters
+    ----------
+    data       : tables.EArray
+    max_bytes  : integer
+        Memory budget of the cached blocks
+    block_rows : integer
+        Rows per cached block, rounded up to whole HDF5 chunks,
+        about 1MB by default
+    Notes
+    -----
+    Slicing reads whole blocks, so a chunk is inflated once for as long
+    as it stays in the cache. `hits` and `misses` count block lookups.
+    """
+    def __init__(self, data, max_bytes=2**28, block_rows=None):
+        self.data = data
+        chunk_rows = data.chunkshape[0]
+        if block_rows is None:
+            block_rows = max(1, 2**20 // data.rowsize)
+        self.block_rows = -(-block_rows // chunk_rows) * chunk_rows
+        self.max_blocks = max(1, max_bytes // (self.block_rows * data.rowsize))
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def _v_file(self):
+        return self.data._v_file
+
+    @property
+    def attrs(self):
+        return self.data.attrs
+
+    def _block(self, i):
+        block = self.blocks.pop(i, None)
+        if block is None:
+            self.misses += 1
+            block = self.data[i * self.block_rows:(i + 1) * self.block_rows]
+            if len(self.blocks) >= self.max_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.hits += 1
+        self.blocks[i] = block
+        return block
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            if isinstance(key, (int, np.integer)):
+                key = key % len(self)
+                return self[key:key + 1][0]
+            return self.data[key]
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            return self.data[key]
+
+        rval = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+        pos = start
+        while pos < stop:
+            i = pos // self.block_rows
+            block = self._block(i)
+            block_start = i * self.block_rows
+            n = min(stop, block_start + len(block)) - pos
+            rval[pos - start:pos - start + n] = block[pos - block_start:pos - block_start + n]
+            pos += n
+        return rval
+
+    def stats(self):
+        return 'Chunk cache: {} hits, {} misses'.format(self.hits, self.misses)
 
 
 if __name__ == "__main__":
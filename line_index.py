@@ -0,0 +1,166 @@
+import mmap
+import os
+import zlib
+
+import numpy
+
+
+class LineIndex(object):
+    """
+    Random access to the lines of a plain or gzip text file
+    Parameters
+    ----------
+    path  : string
+        Path of the text file, gzip if it ends with '.gz'
+    span  : integer
+        Compressed bytes between two gzip checkpoints
+    Notes
+    -----
+    The byte offset of every line is computed once and cached next to the
+    file as `path`.lines.npy. Plain files are memory-mapped. Gzip files get
+    inflate checkpoints every `span` compressed bytes, after which any line
+    is read by inflating the span(s) holding it only. With a cached index
+    the checkpoints are recorded lazily, as far as the reads go, so reading
+    in file order inflates the file once; `permutation` records them all.
+    """
+    def __init__(self, path, span=2**20):
+        self.path = path
+        self.span = span
+        self.is_gzip = path.endswith('.gz')
+        self._file = open(path, 'rb')
+        self._mmap = None
+        self._cached_span = (None, None)
+
+        index_path = path + '.lines.npy'
+        if os.path.isfile(index_path) and \
+                os.path.getmtime(index_path) >= os.path.getmtime(path):
+            self.offsets = numpy.load(index_path)
+            if self.is_gzip:
+                self._reset_checkpoints()
+        else:
+            self.offsets = self._build_index()
+            numpy.save(index_path, self.offsets)
+
+        if not self.is_gzip and self.offsets[-1] > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _reset_checkpoints(self):
+        self._dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._checkpoints = [self._dobj.copy()]
+        self._c_offsets = [0]
+        self._u_offsets = [0]
+        self._gzip_done = False
+
+    def _next_gzip_block(self):
+        """
+        Inflate the span after the last checkpoint and record the next
+        checkpoint. Returns None at the end of the file.
+        """
+        if self._gzip_done:
+            return None
+        self._file.seek(self._c_offsets[-1])
+        block = self._file.read(self.span)
+        if not block:
+            self._gzip_done = True
+            return None
+        data = self._dobj.decompress(block)
+        self._cached_span = (len(self._checkpoints) - 1, data)
+        self._checkpoints.append(self._dobj.copy())
+        self._c_offsets.append(self._c_offsets[-1] + len(block))
+        self._u_offsets.append(self._u_offsets[-1] + len(data))
+        return data
+
+    def _checkpoint_to(self, end):
+        """ Record checkpoints until they cover the first `end` bytes. """
+        while self._u_offsets[-1] < end and self._next_gzip_block() is not None:
+            pass
+
+    def _iter_gzip_blocks(self):
+        """ Inflate the file sequentially, recording checkpoints. """
+        self._reset_checkpoints()
+        while True:
+            data = self._next_gzip_block()
+            if data is None:
+                break
+            yield data
+
+    def _iter_plain_blocks(self):
+        self._file.seek(0)
+        while True:
+            block = self._file.read(self.span)
+            if not block:
+                break
+            yield block
+
+    def _build_index(self):
+        """ Offsets of the start of every line, plus the end of the file. """
+        blocks = self._iter_gzip_blocks() if self.is_gzip else self._iter_plain_blocks()
+        starts = [numpy.zeros(1, dtype='int64')]
+        pos = 0
+        last = b'\n'
+        for block in blocks:
+            newlines = numpy.flatnonzero(numpy.frombuffer(block, dtype=numpy.uint8) == 10)
+            starts.append(newlines.astype('int64') + pos + 1)
+            pos += len(block)
+            last = block[-1:]
+        offsets = numpy.concatenate(starts)
+        if last != b'\n':
+            # last line without a trailing newline
+            offsets = numpy.append(offsets, pos)
+        return offsets
+
+    def _read_span(self, j):
+        """ Inflate the uncompressed bytes between checkpoints j and j+1. """
+        if self._cached_span[0] != j:
+            dobj = self._checkpoints[j].copy()
+            self._file.seek(self._c_offsets[j])
+            if j + 1 < len(self._c_offsets):
+                data = dobj.decompress(
+                    self._file.read(self._c_offsets[j + 1] - self._c_offsets[j]))
+            else:
+                data = dobj.decompress(self._file.read()) + dobj.flush()
+            self._cached_span = (j, data)
+        return self._cached_span[1]
+
+    def _read(self, start, end):
+        if not self.is_gzip:
+            return self._mmap[start:end] if end > start else b''
+        self._checkpoint_to(end)
+        j = numpy.searchsorted(self._u_offsets, start, side='right') - 1
+        chunks = []
+        while start < end:
+            data = self._read_span(j)
+            span_start = self._u_offsets[j]
+            chunks.append(data[start - span_start:end - span_start])
+            start = span_start + len(data)
+            j += 1
+        return b''.join(chunks)
+
+    def read_lines(self, indices):
+        """
+        Lines at `indices`, newline included, in the order of `indices`.
+        Reads are issued in file order so that they stay local.
+        """
+        indices = numpy.asarray(indices)
+        lines = [None] * len(indices)
+        for i in numpy.argsort(indices, kind='mergesort'):
+            lines[i] = self._read(self.offsets[indices[i]],
+                                  self.offsets[indices[i] + 1])
+        return lines
+
+    def permutation(self, rng):
+        """
+        Random order of the lines. For gzip files, checkpoint spans are
+        shuffled and then the lines within each span, so consecutive lines
+        of the order are read from the same few inflated spans.
+        """
+        if not self.is_gzip:
+            return rng.permutation(len(self))
+        self._checkpoint_to(self.offsets[-1])
+        span_of_line = numpy.searchsorted(
+            self._u_offsets, self.offsets[:-1], side='right') - 1
+        span_keys = rng.permutation(len(self._u_offsets))[span_of_line]
+        return numpy.lexsort((rng.rand(len(self)), span_keys))
@@ -1,10 +1,13 @@
 import os
 import json
+import hashlib
 import numpy as np
 import cPickle
 import itertools
 from collections import defaultdict
+from numpy.lib.stride_tricks import as_strided
 from os.path import join as pjoin
+from ragged_array import RaggedArray
 
 
 def chunk(sequence, n):
@@ -13,12 +16,199 @@ def chunk(sequence, n):
         yield sequence[i:i + n]
 
 
-def load_ptb(data_dir, create_pkl=True):
+CORPUS_VERSION = 1
+CORPUS_META = 'vocab.pkl'
+INGEST_BLOCK_SIZE = 2 ** 24
+
+
+def smallest_int_dtype(max_value):
+    """ Smallest unsigned integer dtype able to hold max_value. """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def corpus_exists(corpus_dir):
+    return os.path.isfile(pjoin(corpus_dir, CORPUS_META))
+
+
+def save_corpus(corpus_dir, splits, idx2word, arrays=None, **meta):
+    '''
+    Write a corpus in the on-disk format read by `load_corpus`.
+
+    Every split of `splits` is stored as one flat .npy of token ids using the
+    smallest integer dtype that fits the vocabulary, `arrays` are stored as
+    they are. The vocabulary and `meta` go to a pickled sidecar which is
+    written last, so a partially written corpus is never picked up.
+    '''
+    arrays = arrays or {}
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+
+    dtype = smallest_int_dtype(len(idx2word) - 1)
+    for name, toks in splits.items():
+        np.save(pjoin(corpus_dir, name + '.npy'), np.asarray(toks, dtype=dtype))
+    for name, arr in arrays.items():
+        np.save(pjoin(corpus_dir, name + '.npy'), np.asarray(arr))
+
+    write_corpus_meta(corpus_dir, splits, idx2word, arrays, **meta)
+
+
+def open_corpus_split(corpus_dir, name, length, vocab_size):
+    '''
+    Create the .npy of a split as a writable memory map of `length` ids, so
+    that it can be filled in place without holding the split in memory.
+    '''
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+    return np.lib.format.open_memmap(
+        pjoin(corpus_dir, name + '.npy'), mode='w+',
+        dtype=smallest_int_dtype(vocab_size - 1), shape=(length,))
+
+
+def write_corpus_meta(corpus_dir, splits, idx2word, arrays=(), **meta):
+    '''
+    Write the sidecar of a corpus whose splits and arrays are already on disk.
+    '''
+    meta.update({'corpus_version': CORPUS_VERSION,
+                 'splits': sorted(splits),
+                 'arrays': sorted(arrays),
+                 'dtype': smallest_int_dtype(len(idx2word) - 1).str,
+                 'idx2word': list(idx2word)})
+    with open(pjoin(corpus_dir, CORPUS_META), 'wb') as f:
+        cPickle.dump(meta, f, protocol=-1)
+
+
+def strided_windows(source_seq, length):
+    '''
+    View of every window of `length` consecutive tokens of a 1D sequence, row
+    i being source_seq[i:i + length]. Nothing is copied.
+    '''
+    stride = source_seq.strides[0]
+    return as_strided(source_seq, shape=(source_seq.shape[0] - length + 1, length),
+                      strides=(stride, stride))
+
+
+def flatten_sentences(sentences):
+    '''
+    Concatenate a list of sentences into one token array and the offsets
+    delimiting them: sentence i is tokens[offsets[i]:offsets[i + 1]].
+    '''
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in sentences])
+    if len(sentences) == 0:
+        return np.zeros(0, dtype=np.int64), offsets
+    return np.concatenate(sentences), offsets
+
+
+def load_corpus(corpus_dir, mmap_mode='r'):
+    '''
+    Open a corpus written by `save_corpus`.
+
+    Splits and arrays are memory-mapped, so opening is near-instant and
+    processes reading the same corpus share the page cache.
+    '''
+    with open(pjoin(corpus_dir, CORPUS_META), 'rb') as f:
+        data_dict = cPickle.load(f)
+
+    assert data_dict.get('corpus_version', 0) >= CORPUS_VERSION, \
+        "Old corpus version detected. Delete {} and reprocess it.".format(corpus_dir)
+
+    for name in data_dict['splits'] + data_dict['arrays']:
+        data_dict[name] = np.load(pjoin(corpus_dir, name + '.npy'), mmap_mode=mmap_mode)
+    data_dict['word2idx'] = {w: i for i, w in enumerate(data_dict['idx2word'])}
+    return data_dict
+
+
+def iter_text_blocks(filename, block_size=INGEST_BLOCK_SIZE, whole_words=False):
+    '''
+    Read a file in fixed-size byte blocks. With `whole_words`, blocks are cut
+    after their last whitespace so that no word straddles two blocks.
     '''
-    Load a character-based version of the text8 corpus.
+    carry = b''
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            if whole_words:
+                block = carry + block
+                cut = max(block.rfind(b' '), block.rfind(b'\n')) + 1
+                carry, block = block[cut:], block[:cut]
+            if block:
+                yield block
+    if carry:
+        yield carry
+
+
+def _byte_ids(lut, block):
+    """ Map the bytes of a block to ids through a 256-entry lookup table. """
+    return np.take(lut, np.frombuffer(block, dtype=np.uint8))
+
+
+def _word_ids(vocab, vocab_ids, block):
+    """ Map the words of a block to ids, `vocab` being sorted. """
+    words = block.split()
+    if not words:
+        return vocab_ids[:0]
+    words, inverse = np.unique(np.array(words), return_inverse=True)
+    return vocab_ids[np.searchsorted(vocab, words)][inverse]
+
+
+def _count_words(filenames):
     '''
+    Count words over `filenames` block by block.
 
-    if create_pkl:
+    Returns the sorted vocabulary, the count of each of its words and the
+    number of words of each file.
+    '''
+    uniques, counts, n_words = [], [], []
+    for filename in filenames:
+        n_words.append(0)
+        for block in iter_text_blocks(filename, whole_words=True):
+            words = block.split()
+            if not words:
+                continue
+            u, c = np.unique(np.array(words), return_counts=True)
+            uniques.append(u)
+            counts.append(c)
+            n_words[-1] += len(words)
+    if not uniques:
+        # only empty files: no vocabulary, empty splits
+        return np.zeros(0, dtype='S1'), np.zeros(0, dtype=np.int64), n_words
+    vocab, inverse = np.unique(np.concatenate(uniques), return_inverse=True)
+    word2tf = np.bincount(inverse, weights=np.concatenate(counts))
+    return vocab, word2tf.astype(np.int64), n_words
+
+
+def _write_splits(outputs, id_blocks):
+    '''
+    Write a stream of id blocks across consecutive memory-mapped splits.
+    Empty splits are left as they are, zero-length .npy files.
+    '''
+    outputs = iter([out for out in outputs if len(out)])
+    out, pos = next(outputs, None), 0
+    for ids in id_blocks:
+        while len(ids):
+            if out is None:
+                raise ValueError("{} ids left once every split is full".format(len(ids)))
+            n = min(len(out) - pos, len(ids))
+            out[pos:pos + n] = ids[:n]
+            ids = ids[n:]
+            pos += n
+            if pos == len(out):
+                out.flush()
+                out, pos = next(outputs, None), 0
+
+
+def load_ptb(data_dir, create_corpus=False):
+    '''
+    Load the word-level PTB corpus.
+    '''
+    corpus_dir = os.path.join(data_dir, 'ptb_corpus')
+
+    if create_corpus or not corpus_exists(corpus_dir):
         tr_text = open(os.path.join(data_dir, 'ptb.train.txt')).readlines()
         va_text = open(os.path.join(data_dir, 'ptb.valid.txt')).readlines()
         te_text = open(os.path.join(data_dir, 'ptb.test.txt')).readlines()
@@ -40,143 +230,169 @@ def load_ptb(data_dir, create_pkl=True):
                         id2word.append(word)
                     toks.append(word2id[word])
 
-        # dict for easy handling
-        data_dict = {'train': np.asarray(tr_toks),
-                     'valid': np.asarray(va_toks),
-                     'test': np.asarray(te_toks),
-                     'word2idx': word2id,
-                     'idx2word': id2word}
-
         # dump the processed data for easier reloading
-        f_handle = file(os.path.join(data_dir, 'ptb_dataset.pkl'), 'wb')
-        cPickle.dump(data_dict, f_handle, protocol=-1)
-        f_handle.close()
-    else:
-        # load preprocessed data
-        data_dict = cPickle.load(
-            open(os.path.join(data_dir, 'ptb_dataset.pkl')))
-    return data_dict
+        save_corpus(corpus_dir,
+                    {'train': tr_toks, 'valid': va_toks, 'test': te_toks},
+                    id2word)
+
+    # memory-map the preprocessed data
+    return load_corpus(corpus_dir)
 
 
-def load_enwik8(data_dir, create_pkl=True):
+def load_enwik8(data_dir, create_corpus=False):
     '''
     Load the enwik8 dataset.
     '''
-    if create_pkl:
+    corpus_dir = os.path.join(data_dir, 'enwik8_corpus')
+
+    if create_corpus or not corpus_exists(corpus_dir):
         # get paths to raw text files
         filename = os.path.join(data_dir, 'enwik8.txt')
-        text = open(filename, 'r').read()
-
+        n_bytes = os.path.getsize(filename)
         nchars = 5000000
-        tr_text = text[:-2 * nchars]
-        va_text = text[-2 * nchars:-1 * nchars]
-        te_text = text[-1 * nchars:]
 
-        # initialize arrays for holding data
-        tr_chars, va_chars, te_chars = [], [], []
+        # first pass: ids are given to bytes by order of first occurrence
+        first_seen = np.full(256, n_bytes, dtype=np.int64)
+        offset = 0
+        for block in iter_text_blocks(filename):
+            chars, index = np.unique(np.frombuffer(block, dtype=np.uint8),
+                                     return_index=True)
+            first_seen[chars] = np.minimum(first_seen[chars], index + offset)
+            offset += len(block)
+        chars = np.flatnonzero(first_seen < n_bytes)
+        chars = chars[np.argsort(first_seen[chars], kind='mergesort')]
 
         # initialize maps for fetching chars <-> ints
-        word2id = {'__pad__': 0, '__go__': 1}
-        id2word = ['__pad__', '__go__']
+        id2word = ['__pad__', '__go__'] + [chr(c) for c in chars]
+        lut = np.zeros(256, dtype=smallest_int_dtype(len(id2word) - 1))
+        lut[chars] = np.arange(2, len(id2word))
 
-        # scan text files and convert to lists of int-valued keys
-        for f_text, f_chars in [(tr_text, tr_chars),
-                                (va_text, va_chars),
-                                (te_text, te_chars)]:
-            for c in f_text:
-                if not (c in word2id):
-                    word2id[c] = len(id2word)
-                    id2word.append(c)
-                f_chars.append(word2id[c])
-
-        # dict for easy handling
-        data_dict = {'train': np.asarray(tr_chars),
-                     'valid': np.asarray(va_chars),
-                     'test': np.asarray(te_chars),
-                     'word2idx': word2id,
-                     'idx2word': id2word}
+        # second pass: map blocks through the lookup table straight to disk
+        splits = [('train', n_bytes - 2 * nchars), ('valid', nchars), ('test', nchars)]
+        outputs = [open_corpus_split(corpus_dir, name, length, len(id2word))
+                   for name, length in splits]
+        _write_splits(outputs, (_byte_ids(lut, block)
+                                for block in iter_text_blocks(filename)))
+        write_corpus_meta(corpus_dir, [name for name, _ in splits], id2word)
 
-        # dump the processed data for easier reloading
-        f_handle = file(os.path.join(data_dir, 'enwik8_dataset.pkl'), 'wb')
-        cPickle.dump(data_dict, f_handle, protocol=-1)
-        f_handle.close()
-    else:
-        # load preprocessed data
-        data_dict = cPickle.load(
-            open(os.path.join(data_dir, 'enwik8_dataset.pkl')))
-    return data_dict
+    # memory-map the preprocessed data
+    return load_corpus(corpus_dir)
 
 
-def load_text8(data_dir, level='char', create_pkl=True):
+def load_text8(data_dir, level='char', create_corpus=False):
     '''
     Load the text8 dataset.
     '''
-    if create_pkl:
+    corpus_dir = os.path.join(data_dir, 't8_corpus_{}'.format(level))
+
+    if create_corpus or not corpus_exists(corpus_dir):
         # get paths to raw text files
         tr_file = os.path.join(data_dir, 'text8.train.txt')
         te_file = os.path.join(data_dir, 'text8.test.txt')
 
-        tr_text = open(tr_file, 'r').read()
-        te_text = open(te_file, 'r').read()
-
-        word2id = {'__pad__': 0, '__go__': 1}
-        id2word = ['__pad__', '__go__']
-        word2tf = {}
-
-        tr_toks, te_toks = ([], [])
-
-        # scan text files and convert to lists of int-valued keys
-        for f_text, f_toks in [(tr_text, tr_toks),
-                               (te_text, te_toks)]:
-            if (level == 'word'):
-                f_text = f_text.split()
-            for tok in f_text:
-                if not (tok in word2tf):
-                    word2tf[tok] = 0
-                word2tf[tok] += 1
+        # first pass: count tokens block by block
+        if (level == 'word'):
+            vocab, word2tf, (n_tr, n_te) = _count_words([tr_file, te_file])
+        else:
+            word2tf = np.zeros(256, dtype=np.int64)
+            for f_name in (tr_file, te_file):
+                for block in iter_text_blocks(f_name):
+                    word2tf += np.bincount(np.frombuffer(block, dtype=np.uint8),
+                                           minlength=256)
+            n_tr, n_te = os.path.getsize(tr_file), os.path.getsize(te_file)
 
         # sort word ids by frequency
-        mc_wrd = sorted(word2tf.items(), key=lambda x: x[1], reverse=True)
-        for wrd, _ in mc_wrd:
-            word2id[wrd] = len(id2word)
-            id2word.append(wrd)
+        mc_wrd = np.argsort(-word2tf, kind='mergesort')
+        mc_wrd = mc_wrd[word2tf[mc_wrd] > 0]
+        vocab_ids = np.zeros(len(word2tf), dtype=smallest_int_dtype(len(mc_wrd) + 1))
+        vocab_ids[mc_wrd] = np.arange(2, len(mc_wrd) + 2)
 
-        for f_text, f_toks in [(tr_text, tr_toks),
-                               (te_text, te_toks)]:
-            if (level == 'word'):
-                f_text = f_text.split()
-            for tok in f_text:
-                assert (tok in word2id), 'something went wrong'
-                f_toks.append(word2id[tok])
+        id2word = ['__pad__', '__go__']
+        if (level == 'word'):
+            id2word += vocab[mc_wrd].tolist()
+            to_ids = lambda block: _word_ids(vocab, vocab_ids, block)
+        else:
+            id2word += [chr(c) for c in mc_wrd]
+            to_ids = lambda block: _byte_ids(vocab_ids, block)
 
         # build valid dataset ~ 1% of training tokens
-        tr_len = int(len(tr_toks) * 0.99)
-        va_toks = tr_toks[tr_len:]
-        tr_toks = tr_toks[:tr_len]
+        tr_len = int(n_tr * 0.99)
+        va_len = n_tr - tr_len
 
         print('-- created t8 dataset, vocabulary: {}, tr_toks: {}, va_toks: {}, te_toks: {}'.format(
-              len(word2id), len(tr_toks), len(va_toks), len(te_toks)))
+              len(id2word), tr_len, va_len, n_te))
 
-        # dict for easy handling
-        data_dict = {'train': np.asarray(tr_toks),
-                     'valid': np.asarray(va_toks),
-                     'test': np.asarray(te_toks),
-                     'word2idx': word2id,
-                     'idx2word': id2word}
+        # second pass: write the ids of each block straight to disk
+        tr_toks = open_corpus_split(corpus_dir, 'train', tr_len, len(id2word))
+        va_toks = open_corpus_split(corpus_dir, 'valid', va_len, len(id2word))
+        te_toks = open_corpus_split(corpus_dir, 'test', n_te, len(id2word))
+        for f_name, outputs in [(tr_file, [tr_toks, va_toks]),
+                                (te_file, [te_toks])]:
+            blocks = iter_text_blocks(f_name, whole_words=(level == 'word'))
+            _write_splits(outputs, (to_ids(block) for block in blocks))
+        write_corpus_meta(corpus_dir, ['train', 'valid', 'test'], id2word)
 
-        # dump the processed data for easier reloading
-        with open(os.path.join(data_dir, 't8_dataset_{}.pkl'.format(level)), 'wb') as f:
-            cPickle.dump(data_dict, f, protocol=-1)
+    # memory-map the preprocessed data
+    return load_corpus(corpus_dir)
 
-    else:
-        # load preprocessed data
-        with open(os.path.join(data_dir, 't8_dataset_{}.pkl'.format(level)), 'rb') as f:
-            data_dict = cPickle.load(f)
 
-    return data_dict
+def _tokenize_reviews(reviews):
+    """ Split each review into sentences of words with nltk punkt. """
+    from nltk.tokenize import sent_tokenize, word_tokenize
+    return [[word_tokenize(s) for s in sent_tokenize(review.lower())]
+            for review in reviews]
+
 
+def _shard_key(reviews):
+    '''Hash of the text of `reviews`.'''
+    sha = hashlib.sha1()
+    for review in reviews:
+        sha.update(review.encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()[:16]
 
-def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk=None):
+
+def tokenize_reviews(reviews, cache_dir, shard_size=10000, n_jobs=None):
+    '''
+    Tokenize reviews shard by shard over a process pool.
+
+    Each shard is pickled to `cache_dir` once tokenized and reused on later
+    calls, keyed by the hash of its reviews so that an edited input is
+    tokenized again. Shards are merged in order, so the result does not
+    depend on `n_jobs` (defaults to the number of CPUs).
+    '''
+    from multiprocessing import Pool
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    shards = list(chunk(reviews, shard_size))
+    paths = [pjoin(cache_dir, 'shard{}_{:05d}_{}.pkl'.format(shard_size, i, _shard_key(shard)))
+             for i, shard in enumerate(shards)]
+    todo = [i for i, path in enumerate(paths) if not os.path.isfile(path)]
+
+    if todo:
+        pool = Pool(n_jobs)
+        try:
+            results = pool.imap(_tokenize_reviews, [shards[i] for i in todo])
+            for n, (i, tokens) in enumerate(zip(todo, results)):
+                # write then rename so an interrupted run leaves no partial shard
+                with open(paths[i] + '.tmp', 'wb') as f:
+                    cPickle.dump(tokens, f, protocol=-1)
+                os.rename(paths[i] + '.tmp', paths[i])
+                print("Tokenized shard {} / {}".format(n + 1, len(todo)))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    tokenized = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            tokenized.extend(cPickle.load(f))
+    return tokenized
+
+
+def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk=None, n_jobs=None):
     ''' Loads the IMDB dataset used in JMARS [1].
 
     This is a collection of 350k movie reviews. Each review has the following
@@ -198,26 +414,33 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
     ----------
     dir_path : str
         The path to the directory containing dataset files.
+    n_jobs : int
+        Number of processes tokenizing the reviews, all CPUs by default. The
+        tokenization is cached in `dir_path`/imdb_jmars_tokens and shared by
+        every `max_sentence_len`/`min_sentence_len`.
 
     Returns
     -------
     data_dict : dict
         Dictionary containing the following items:
-            'train': list of ndarray of int
-                List of sentences composing the training set.
-            'valid': list of ndarray of int
-                List of sentences composing the validation set.
-            'test': list of ndarray of int
-                List of sentences composing the ttesting set.
+            'train': RaggedArray
+                Sentences composing the training set.
+            'valid': RaggedArray
+                Sentences composing the validation set.
+            'test': RaggedArray
+                Sentences composing the ttesting set.
+            'train_offsets', 'valid_offsets', 'test_offsets': ndarray of int
+                Boundaries of the sentences in the flat token array of each
+                split; sentence i spans offsets[i]:offsets[i+1].
             'word2idx': dict
                 Mapping between words and words' IDs
             'idx2word': list
                 Mapping between words' IDs and words
             'word2tf': dict
                 Words frequencies
-            'reviews_ids': list of int
+            'reviews_ids': ndarray of int
                 List of reviews' ids for each sentence in the whole dataset.
-            'ratings': list of int
+            'ratings': ndarray of int
                 List of ratings for each review in the whole dataset.
 
     References
@@ -228,16 +451,16 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
     [2] This dataset comes from http://mattmahoney.net/dc/text8.zip
     [3] Code repository https://github.com/nihalb/JMARS
     '''
-    VERSION = 3
+    VERSION = 4
     SPECIAL_TOKENS = ['__pad__', '<S>', '</S>', '<unk>']
 
     if dir_path is None:
         dir_path = pjoin(".", "imdb", "data")
 
     if max_sentence_len is not None:
-        filename = "imdb_jmars_maxlen{}_minlen{}.pkl".format(max_sentence_len, min_sentence_len)
+        filename = "imdb_jmars_maxlen{}_minlen{}".format(max_sentence_len, min_sentence_len)
     else:
-        filename = "imdb_jmars.pkl"
+        filename = "imdb_jmars"
         max_sentence_len = np.inf
 
     path = pjoin(dir_path, filename)
@@ -248,7 +471,7 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
     except:
         pass
 
-    if not os.path.isfile(path):
+    if not corpus_exists(path):
         # Download the dataset.
         data_dir, data_file = os.path.split(path)
         data_file = os.path.join(data_dir, 'data.json')
@@ -270,8 +493,10 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
 
         # Use nltk punkt to extract sentences.
         import nltk
-        from nltk.tokenize import sent_tokenize, word_tokenize
         nltk.download('punkt')  # Download resource if needed.
+        tokenized = tokenize_reviews([d['review'] for d in data],
+                                     pjoin(dir_path, 'imdb_jmars_tokens'),
+                                     n_jobs=n_jobs)
 
         n_reviews = len(data)
         ratings = np.zeros(n_reviews, dtype=np.int8)
@@ -279,11 +504,8 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
 
         word2tf = defaultdict(lambda: 0)
         dataset = []
-        for i, d in enumerate(data):
-            review = d['review'].lower()
-
-            for s in sent_tokenize(review):
-                words = word_tokenize(s)
+        for i, (d, sentences) in enumerate(zip(data, tokenized)):
+            for words in sentences:
                 if len(words) > max_sentence_len:
                     continue
 
@@ -326,25 +548,19 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
         print('-- created imdb (JMARS) dataset, vocabulary: {:,}, tr_toks: {:,}, va_toks: {:,}, te_toks: {:,}'.format(
               len(word2idx), len(tr_toks), len(va_toks), len(te_toks)))
 
-        # dict for easy handling
-        data_dict = {'version': VERSION,
-                     'train': tr_toks,
-                     'valid': va_toks,
-                     'test': te_toks,
-                     'word2idx': word2idx,
-                     'idx2word': idx2word,
-                     'word2tf': dict(word2tf),
-                     'reviews_ids': reviews_ids,
-                     'ratings': ratings}
+        # dump the processed data for easier reloading, sentences of each
+        # split are concatenated and delimited by an offsets array.
+        splits, offsets = {}, {}
+        for name, sentences in (('train', tr_toks), ('valid', va_toks), ('test', te_toks)):
+            splits[name], offsets[name + '_offsets'] = flatten_sentences(sentences)
 
-        # dump the processed data for easier reloading
-        with open(path, 'wb') as f_handle:
-            cPickle.dump(data_dict, f_handle, protocol=-1)
+        offsets['reviews_ids'] = reviews_ids
+        offsets['ratings'] = ratings
+        save_corpus(path, splits, idx2word, arrays=offsets,
+                    version=VERSION, word2tf=dict(word2tf))
 
-    else:
-        # load preprocessed data
-        with open(path, 'rb') as f_handle:
-            data_dict = cPickle.load(f_handle)
+    # memory-map the preprocessed data
+    data_dict = load_corpus(path)
 
     assert data_dict.get('version', 1) >= VERSION, "Old version dectected. Delete dataset and reprocess it."
 
@@ -353,15 +569,10 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
         # -= Keep the most K frequent words =-
         unk_id = data_dict['word2idx']["<unk>"]
 
-        def _prune(dataset):
-            for i, sentence in enumerate(dataset):
-                for j, e in enumerate(sentence):
-                    if e >= topk:
-                        dataset[i][j] = unk_id
-
-        _prune(data_dict['train'])
-        _prune(data_dict['valid'])
-        _prune(data_dict['test'])
+        # The mapped splits are read-only, pruning makes an in-memory copy.
+        for name in ('train', 'valid', 'test'):
+            toks = data_dict[name]
+            data_dict[name] = np.where(toks >= topk, unk_id, toks).astype(np.int32)
 
         data_dict['word2idx'] = {w: i for w, i in data_dict['word2idx'].items() if i < topk}
         data_dict['idx2word'] = data_dict['idx2word'][:topk]
@@ -369,18 +580,21 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
         # Check integrity
         assert len(data_dict['idx2word']) == topk
         assert len(data_dict['word2idx']) == topk
-        assert np.all([np.all(s < topk) for s in data_dict['train']])
-        assert np.all([np.all(s < topk) for s in data_dict['valid']])
-        assert np.all([np.all(s < topk) for s in data_dict['test']])
+        assert np.all(data_dict['train'] < topk)
+        assert np.all(data_dict['valid'] < topk)
+        assert np.all(data_dict['test'] < topk)
 
         print("Keeping top {:,} most frequent words.".format(topk-2))
 
+    for name in ('train', 'valid', 'test'):
+        data_dict[name] = RaggedArray(data_dict[name], data_dict[name + '_offsets'])
+
     data_dict["name"] = "IMDB"
     data_dict["level"] = "w"
     data_dict["max_seq_len"] = max_sentence_len
     data_dict["min_seq_len"] = min_sentence_len
     data_dict["vocab_size"] = len(data_dict["idx2word"])
-    data_dict["vocab_path"] = path[:-4] + ".tsv"
+    data_dict["vocab_path"] = path + ".tsv"
 
     if not os.path.isfile(data_dict["vocab_path"]):
         with open(data_dict["vocab_path"], "w") as f:
@@ -392,7 +606,7 @@ def load_imdb_jmars(dir_path=None, max_sentence_len=16, min_sentence_len=5, topk
 class Text8():
     def __init__(self, data_path, seq_len, batch_size, level="word", rng_seed=1234):
         # load ptb word sequence
-        text8_data = load_text8(data_path, level=level, create_pkl=False)
+        text8_data = load_text8(data_path, level=level)
 
         self.tr_words = text8_data['train']
         self.va_words = text8_data['valid']
@@ -416,18 +630,13 @@ class Text8():
 
     def _sample_subseqs(self, source_seq, seq_count, seq_len):
         '''
-        Sample subsequences of the given source sequence.
+        Sample start positions of subsequences of the given source sequence.
         '''
         source_len = source_seq.shape[0]
         max_start_idx = source_len - seq_len
         # sample the "base" sequences
         start_idx = self.rng.randint(low=0, high=max_start_idx, size=(seq_count,))
-        idx_seqs = []
-        for i in range(seq_count):
-            subseq = source_seq[start_idx[i]:(start_idx[i] + seq_len)]
-            idx_seqs.append(subseq[np.newaxis, :])
-        idx_seqs = np.vstack(idx_seqs)
-        return idx_seqs.astype("int64")
+        return start_idx
 
     def _prepare_heldout_set(self, source_seq):
         '''build validation/test set
@@ -455,25 +664,28 @@ class Text8():
 
     def _prepare_training_set(self, source_seq, n_batches=500):
         '''
-        Prepare a sample from the source sequence.
+        Lazily yield the batches of a sample from the source sequence.
+
+        Each batch is gathered from a strided view of all the windows of the
+        source, so only the batch being yielded is materialized.
         '''
-        # sample a batch of one-hot subsequences from the source sequence
-        x = self._sample_subseqs(source_seq, self.batch_size, self.seq_len * n_batches)
-        x = np.concatenate([np.zeros((self.batch_size, 1)), x], axis=1)
-        x = x.astype("int64")
-        x_in = x[:, :-1]
-        y_in = x[:, 1:]
-        X = [x_in[:, i:i + self.seq_len] for i in range(0, x_in.shape[1], self.seq_len)]
-        Y = [y_in[:, i:i + self.seq_len] for i in range(0, y_in.shape[1], self.seq_len)]
-        M = [np.not_equal(y, 0).astype('float32') for y in Y]
-        assert (len(X) == n_batches)
-        assert (len(Y) == n_batches)
-        assert (len(M) == n_batches)
-        return X, Y, M
+        # sample a batch of subsequences from the source sequence
+        start_idx = self._sample_subseqs(source_seq, self.batch_size, self.seq_len * n_batches)
+        windows = strided_windows(source_seq, self.seq_len + 1)
+        for i in range(n_batches):
+            x = np.empty((self.batch_size, self.seq_len + 1), dtype="int64")
+            if i == 0:
+                # start with 0 vector (first token prediction)
+                x[:, 0] = 0
+                x[:, 1:] = windows[start_idx, :-1]
+            else:
+                x[:] = windows[start_idx + i * self.seq_len - 1]
+            x_in = x[:, :-1]
+            y_in = x[:, 1:]
+            yield x_in, y_in, np.not_equal(y_in, 0).astype('float32')
 
     def get_train_batch(self):
-        X, Y, M = self._prepare_training_set(self.tr_words)
-        for batch in zip(X, Y, M):
+        for batch in self._prepare_training_set(self.tr_words):
             yield batch
 
     def get_valid_batch(self):
@@ -489,7 +701,7 @@ class Text8():
 
 class IMDB_JMARS():
     def __init__(self, data_path, seq_len, batch_size,
-                 topk=16000, rng_seed=1234):
+                 topk=16000, rng_seed=1234, bucketed=False):
         # load ptb word sequence
         data = load_imdb_jmars(
             data_path, max_sentence_len=seq_len,
@@ -521,26 +733,29 @@ class IMDB_JMARS():
 
         # Indices for trainset
         self.indices_trainset = np.arange(len(self.tr_words))
+        # Group training sentences of similar lengths in the same batches
+        self.bucketed = bucketed
+        # Fraction of padded steps in the training batches of the last epoch
+        self.padding_ratio = None
 
-    def pad_batch(self, sentences):
+    def pad_batch(self, sentences, indices=None, **kwargs):
         """
         Pad each sentence with __pad__ token so they all have the same length.
+        `sentences` is a list of sentences or a RaggedArray, from which only
+        the sentences at `indices` are taken if given.
         """
-        max_len = max(map(len, sentences))
-        batch = self.pad_id * np.ones((len(sentences), max_len), dtype=int)
-        for i, sentence in enumerate(sentences):
-            batch[i, :len(sentence)] = sentence
-        return batch
+        if not isinstance(sentences, RaggedArray):
+            sentences = RaggedArray(*flatten_sentences(sentences))
+        if indices is None:
+            indices = np.arange(len(sentences))
+        return sentences.pad(indices, pad_id=self.pad_id, **kwargs)
 
-    def prepare_batch(self, sentences):
+    def prepare_batch(self, sentences, indices=None):
         """
         Add <S> and </S> tokens to each sentence and pad the batch.
         """
-        def _add_special_symbols(s):
-            return [self.bos_id] + list(s) + [self.eos_id]
-
-        sents = [_add_special_symbols(s) for s in sentences]
-        batch = self.pad_batch(sents)
+        batch = self.pad_batch(sentences, indices,
+                               bos_id=self.bos_id, eos_id=self.eos_id)
         x = batch[:, :-1]
         y = batch[:, 1:]
         m = np.not_equal(y, self.pad_id).astype('float32')
@@ -570,30 +785,50 @@ class IMDB_JMARS():
             else:
                 print(" ".join(sentence))
 
-    def get_train_batch(self, shuffle=True):
-        if shuffle:
-            self.rng.shuffle(self.indices_trainset)  # In-place
-
-        for indices in chunk(self.indices_trainset, n=self.batch_size):
-            if len(indices) != self.batch_size:
-                continue  # Feeling lazy, skip incomplete batch.
+    def _bucketed_batches(self):
+        '''
+        Batches of training indices holding sentences of similar lengths.
+        Sentences are shuffled, stably sorted by length and cut into batches,
+        whose order is shuffled in turn.
+        '''
+        indices = self.rng.permutation(len(self.tr_words))
+        # drop a random remainder rather than the longest sentences
+        indices = indices[len(indices) % self.batch_size:]
+        order = np.argsort(self.tr_words.lengths[indices], kind='mergesort')
+        batches = indices[order].reshape((-1, self.batch_size))
+        return batches[self.rng.permutation(len(batches))]
 
-            batch = [self.tr_words[idx] for idx in indices]
-            yield self.prepare_batch(batch)
+    def get_train_batch(self, shuffle=True):
+        if self.bucketed and shuffle:
+            batches = self._bucketed_batches()
+        else:
+            if shuffle:
+                self.rng.shuffle(self.indices_trainset)  # In-place
+            # Feeling lazy, skip incomplete batch.
+            batches = (indices for indices in chunk(self.indices_trainset, n=self.batch_size)
+                       if len(indices) == self.batch_size)
+
+        n_steps, n_padded = 0, 0
+        for indices in batches:
+            x, y, m = self.prepare_batch(self.tr_words, indices)
+            n_steps += m.size
+            n_padded += m.size - m.sum()
+            self.padding_ratio = n_padded / float(n_steps)
+            yield x, y, m
 
     def get_valid_batch(self):
-        for batch in chunk(self.va_words, n=self.batch_size):
-            yield self.prepare_batch(batch)
+        for indices in chunk(np.arange(len(self.va_words)), n=self.batch_size):
+            yield self.prepare_batch(self.va_words, indices)
 
     def get_test_batch(self):
-        for batch in chunk(self.te_words, n=self.batch_size):
-            yield self.prepare_batch(batch)
+        for indices in chunk(np.arange(len(self.te_words)), n=self.batch_size):
+            yield self.prepare_batch(self.te_words, indices)
 
 
 class PTB():
     def __init__(self, data_path, seq_len, batch_size, rng_seed=1234):
         # load ptb word sequence
-        text8_data = load_ptb(data_path, create_pkl=True)
+        text8_data = load_ptb(data_path)
 
         self.tr_words = text8_data['train']
         self.va_words = text8_data['valid']
@@ -620,19 +855,14 @@ class PTB():
 
     def _sample_subseqs(self, source_seq, seq_count, seq_len):
         '''
-        Sample subsequences of the given source sequence.
+        Sample start positions of subsequences of the given source sequence.
         '''
         source_len = source_seq.shape[0]
         max_start_idx = source_len - seq_len
         # sample the "base" sequences
         start_idx = self.rng.randint(
             low=0, high=max_start_idx, size=(seq_count,))
-        idx_seqs = []
-        for i in range(seq_count):
-            subseq = source_seq[start_idx[i]:(start_idx[i] + seq_len)]
-            idx_seqs.append(subseq[np.newaxis, :])
-        idx_seqs = np.vstack(idx_seqs)
-        return idx_seqs.astype("int64")
+        return start_idx
 
     def _prepare_heldout_set(self, source_seq):
         '''build validation/test set
@@ -660,25 +890,28 @@ class PTB():
 
     def _prepare_training_set(self, source_seq, n_batches=500):
         '''
-        Prepare a sample from the source sequence.
+        Lazily yield the batches of a sample from the source sequence.
+
+        Each batch is gathered from a strided view of all the windows of the
+        source, so only the batch being yielded is materialized.
         '''
-        # sample a batch of one-hot subsequences from the source sequence
-        x = self._sample_subseqs(source_seq, self.batch_size, self.seq_len * n_batches)
-        x = np.concatenate([np.zeros((self.batch_size, 1)) + self.bos_id, x], axis=1)
-        x = x.astype("int64")
-        x_in = x[:, :-1]
-        y_in = x[:, 1:]
-        X = [x_in[:, i:i + self.seq_len] for i in range(0, x_in.shape[1], self.seq_len)]
-        Y = [y_in[:, i:i + self.seq_len] for i in range(0, y_in.shape[1], self.seq_len)]
-        M = [np.not_equal(y, 0).astype('float32') for y in Y]
-        assert (len(X) == n_batches)
-        assert (len(Y) == n_batches)
-        assert (len(M) == n_batches)
-        return X, Y, M
+        # sample a batch of subsequences from the source sequence
+        start_idx = self._sample_subseqs(source_seq, self.batch_size, self.seq_len * n_batches)
+        windows = strided_windows(source_seq, self.seq_len + 1)
+        for i in range(n_batches):
+            x = np.empty((self.batch_size, self.seq_len + 1), dtype="int64")
+            if i == 0:
+                # start with bos token (first token prediction)
+                x[:, 0] = self.bos_id
+                x[:, 1:] = windows[start_idx, :-1]
+            else:
+                x[:] = windows[start_idx + i * self.seq_len - 1]
+            x_in = x[:, :-1]
+            y_in = x[:, 1:]
+            yield x_in, y_in, np.not_equal(y_in, 0).astype('float32')
 
     def get_train_batch(self):
-        X, Y, M = self._prepare_training_set(self.tr_words)
-        for batch in zip(X, Y, M):
+        for batch in self._prepare_training_set(self.tr_words):
             yield batch
 
     def get_valid_batch(self):
@@ -690,3 +923,319 @@ class PTB():
         X, Y, M = self._prepare_heldout_set(self.te_words)
         for batch in zip(X, Y, M):
             yield batch
+
+
+def _share_shifted(u, x):
+    '''
+    Store inputs `u` and targets `x` shifted by one step as a single array
+    and return both as views of it, or (u, x) unchanged when x is not
+    u shifted.
+    '''
+    if u.shape != x.shape or not np.array_equal(u[:, 1:], x[:, :-1]):
+        return u, x
+    seq = np.concatenate([u, x[:, -1:]], axis=1)
+    return seq[:, :-1], seq[:, 1:]
+
+
+class TimitData(object):
+    '''
+    Batches of the TIMIT / MIDI npz files, where u is the input and x
+    the target.
+
+    Batches are contiguous slices of the split. With `shuffle`, the
+    training set is permuted once per epoch in a single gather. With
+    `shared_inputs`, a split whose x is u shifted by one step is stored
+    once and u, x are views of it, which halves its memory.
+    '''
+    def __init__(self, fn, batch_size, shuffle=False, shared_inputs=False, seed=1234):
+        print('Loading {}'.format(fn))
+        data = np.load(fn)
+
+        ####
+        # IMPORTANT: u_train is the input and x_train is the target.
+        ##
+        u_train, x_train = data['u_train'], data['x_train']
+        u_valid, x_valid = data['u_valid'], data['x_valid']
+        (u_test, x_test, mask_test) = data['u_test'],  data['x_test'], data['mask_test']
+
+        # test that x and u are correctly shifted
+        assert np.sum(u_train[:, 1:] - x_train[:, :-1]) == 0.0
+        assert np.sum(u_valid[:, 1:] - x_valid[:, :-1]) == 0.0
+        for row in range(u_test.shape[0]):
+            l = int(mask_test[row].sum())
+            if l > 0:  # if l is zero the sequence is fully padded.
+                assert np.sum(u_test[row, 1:l] -
+                              x_test[row, :l-1]) == 0.0, row
+
+        # make multiple of batchsize
+        n_test_padded = ((u_test.shape[0] // batch_size) + 1)*batch_size
+        assert n_test_padded > u_test.shape[0]
+        pad = n_test_padded - u_test.shape[0]
+        u_test = np.pad(u_test, ((0, pad), (0, 0), (0, 0)), mode='constant')
+        x_test = np.pad(x_test, ((0, pad), (0, 0), (0, 0)), mode='constant')
+        mask_test = np.pad(mask_test, ((0, pad), (0, 0)), mode='constant')
+
+        if shared_inputs:
+            u_train, x_train = _share_shifted(u_train, x_train)
+            u_valid, x_valid = _share_shifted(u_valid, x_valid)
+            u_test, x_test = _share_shifted(u_test, x_test)
+
+        self.u_train = u_train
+        self.x_train = x_train
+        self.u_valid = u_valid
+        self.x_valid = x_valid
+        self.u_test = u_test
+        self.x_test = x_test
+        self.mask_test = mask_test
+
+        self.n_train = u_train.shape[0]
+        self.n_valid = u_valid.shape[0]
+        self.n_test = u_test.shape[0]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self._ones = None
+
+        print("TRAINING SAMPLES LOADED", self.u_train.shape)
+        print("TEST SAMPLES LOADED", self.u_test.shape)
+        print("VALID SAMPLES LOADED", self.u_valid.shape)
+        print("TEST AVG LEN        ", np.mean(self.mask_test.sum(axis=1)) * 200)
+
+    def _ones_mask(self, n, length):
+        # shared by the batches without a mask, not to be written to
+        if self._ones is None or self._ones.shape[0] < n or self._ones.shape[1] != length:
+            self._ones = np.ones((max(n, self.batch_size), length), dtype='float32')
+        return self._ones[:n]
+
+    def _permuted(self, u, x):
+        '''
+        Gather a permutation of the split, in one go when u and x are
+        views of the same array.
+        '''
+        perm = self.rng.permutation(len(u))
+        seq = u.base
+        if seq is not None and seq is x.base and seq.shape[1] == u.shape[1] + 1:
+            seq = seq[perm]
+            return seq[:, :-1], seq[:, 1:]
+        return u[perm], x[perm]
+
+    def _iter_data(self, u, x, mask=None):
+        # IMPORTANT: In SRNN (where the data come from) u refers to the input whereas x, to the target.
+        for i in range(0, len(u), self.batch_size):
+            u_batch, x_batch = u[i:i + self.batch_size], x[i:i + self.batch_size]
+            if mask is None:
+                mask_batch = self._ones_mask(x_batch.shape[0], x_batch.shape[1])
+            else:
+                mask_batch = mask[i:i + self.batch_size]
+            yield u_batch, x_batch, mask_batch
+
+    def get_train_batch(self):
+        u, x = self.u_train, self.x_train
+        if self.shuffle:
+            u, x = self._permuted(u, x)
+        return iter(self._iter_data(u, x))
+
+    def get_valid_batch(self):
+        return iter(self._iter_data(self.u_valid, self.x_valid))
+
+    def get_test_batch(self):
+        return iter(self._iter_data(self.u_test, self.x_test, mask=self.mask_test))
+
+
+PIANO_ROLL_SPLITS = ('train', 'valid', 'test')
+
+
+def pack_piano_roll(fn, packed_fn):
+    '''
+    Convert a MIDI npz of float piano rolls (u, x and mask_test as read by
+    TimitData) into bit-packed rolls.
+
+    The inputs and targets of a sequence are stored once, as the
+    (length + 1) frames u[0], ..., u[length - 1], x[length - 1], each frame
+    being its pitches packed 8 per byte. Lengths come from the mask of the
+    split, the full sequence length without one.
+    '''
+    data = np.load(fn)
+    arrays = {}
+    for split in PIANO_ROLL_SPLITS:
+        u, x = data['u_' + split], data['x_' + split]
+        n, length, n_pitches = u.shape
+        if 'mask_' + split in data.files:
+            lengths = data['mask_' + split].sum(axis=1).astype('int64')
+        else:
+            lengths = np.zeros(n, dtype='int64') + length
+        steps = np.arange(length)[None, :] < lengths[:, None]
+
+        roll = np.zeros((n, length + 1, n_pitches), dtype='uint8')
+        roll[:, :-1][steps] = u[steps]
+        rows = np.flatnonzero(lengths)
+        roll[rows, lengths[rows]] = x[rows, lengths[rows] - 1]
+
+        # x must be u shifted by one step, and zero past the end
+        if not np.array_equal(roll[:, 1:] * steps[:, :, None], x):
+            raise ValueError("{}: x_{} is not u_{} shifted by one step".format(fn, split, split))
+
+        arrays[split + '_bits'] = np.packbits(roll, axis=-1)
+        arrays[split + '_lengths'] = lengths
+    arrays['n_pitches'] = n_pitches
+
+    # write then rename, so that concurrent runs never read a partial file
+    tmp_fn = packed_fn + '.tmp.npz'
+    np.savez(tmp_fn, **arrays)
+    os.rename(tmp_fn, packed_fn)
+
+
+class PianoRollData(TimitData):
+    '''
+    TimitData over the bit-packed version of a MIDI npz, written by
+    `pack_piano_roll` next to `fn` on first use.
+
+    Only the packed rolls are kept in memory, every batch is unpacked to
+    float32 when it is drawn, i.e. in the prefetch thread when iterated by
+    a Prefetcher. Inputs past the end of a test sequence are zeros.
+    '''
+    def __init__(self, fn, batch_size, shuffle=False, seed=1234):
+        packed_fn = os.path.splitext(fn)[0] + '_packed.npz'
+        if not os.path.exists(packed_fn):
+            print('Packing {}'.format(fn))
+            pack_piano_roll(fn, packed_fn)
+        print('Loading {}'.format(packed_fn))
+        data = np.load(packed_fn)
+
+        self.n_pitches = int(data['n_pitches'])
+        self.bits_train, self.len_train = data['train_bits'], data['train_lengths']
+        self.bits_valid, self.len_valid = data['valid_bits'], data['valid_lengths']
+        bits_test, len_test = data['test_bits'], data['test_lengths']
+
+        # make multiple of batchsize
+        n_test_padded = ((bits_test.shape[0] // batch_size) + 1)*batch_size
+        pad = n_test_padded - bits_test.shape[0]
+        self.bits_test = np.pad(bits_test, ((0, pad), (0, 0), (0, 0)), mode='constant')
+        self.len_test = np.pad(len_test, (0, pad), mode='constant')
+
+        self.n_train = self.bits_train.shape[0]
+        self.n_valid = self.bits_valid.shape[0]
+        self.n_test = self.bits_test.shape[0]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self._ones = None
+
+        print("TRAINING SAMPLES LOADED", self.bits_train.shape)
+        print("TEST SAMPLES LOADED", self.bits_test.shape)
+        print("VALID SAMPLES LOADED", self.bits_valid.shape)
+
+    def _unpack(self, bits):
+        roll = np.unpackbits(bits, axis=-1)[..., :self.n_pitches]
+        return roll.astype('float32')
+
+    def _iter_data(self, bits, lengths=None):
+        for i in range(0, len(bits), self.batch_size):
+            roll = self._unpack(bits[i:i + self.batch_size])
+            u_batch, x_batch = roll[:, :-1], roll[:, 1:]
+            if lengths is None:
+                mask_batch = self._ones_mask(x_batch.shape[0], x_batch.shape[1])
+            else:
+                steps = np.arange(x_batch.shape[1])
+                mask_batch = (steps[None, :] < lengths[i:i + self.batch_size, None]).astype('float32')
+                # u and x overlap in roll, so they are masked out of place
+                u_batch = u_batch * mask_batch[:, :, None]
+                x_batch = x_batch * mask_batch[:, :, None]
+            yield u_batch, x_batch, mask_batch
+
+    def get_train_batch(self):
+        bits = self.bits_train
+        if self.shuffle:
+            bits = bits[self.rng.permutation(len(bits))]
+        return iter(self._iter_data(bits))
+
+    def get_valid_batch(self):
+        return iter(self._iter_data(self.bits_valid))
+
+    def get_test_batch(self):
+        return iter(self._iter_data(self.bits_test, self.len_test))
+
+
+MNIST_SPLITS = (('train', 'train', slice(None, 50000)),
+                ('valid', 'train', slice(50000, None)),
+                ('test', 'test', None))
+
+
+def load_mnist(data_dir, mmap_mode='r'):
+    '''
+    MNIST images as memory-mapped (n, 784) uint8 arrays, split as in
+    lm_lstm_mnist: train holds the first 50000 training images and valid
+    the last 10000.
+
+    The arrays are extracted once into `data_dir` from fuel's mnist.hdf5,
+    fuel is not needed afterwards.
+    '''
+    paths = dict((split, pjoin(data_dir, 'mnist_{}.npy'.format(split)))
+                 for split, _, _ in MNIST_SPLITS)
+    if not all(os.path.exists(path) for path in paths.values()):
+        import fuel.datasets
+        for split, which_set, subset in MNIST_SPLITS:
+            kwargs = {} if subset is None else {'subset': subset}
+            dataset = fuel.datasets.MNIST(which_sets=(which_set,), sources=('features',), **kwargs)
+            state = dataset.open()
+            features = dataset.get_data(state, slice(0, dataset.num_examples))[0]
+            dataset.close(state)
+            # write then rename so an interrupted run leaves no partial array
+            tmp_path = paths[split][:-len('.npy')] + '.tmp.npy'
+            np.save(tmp_path, features.reshape(len(features), -1).astype('uint8'))
+            os.rename(tmp_path, paths[split])
+    return dict((split, np.load(path, mmap_mode=mmap_mode)) for split, path in paths.items())
+
+
+class MNISTData(object):
+    '''
+    Sequential binarized MNIST batches, read from the memory-mapped
+    arrays of `load_mnist`.
+    Parameters
+    ----------
+    data_dir   : string
+    batch_size : integer
+        Incomplete batches are dropped
+    seed       : integer
+    Notes
+    -----
+    Batches are (x, y, x_mask) with x = y of shape (784, batch_size),
+    time-major, and hold stochastically binarized pixels. Training images
+    are shuffled every epoch, valid and test images are binarized the same
+    way every time. Every batch gets arrays of its own, so batches can be
+    held while the next ones are drawn, e.g. by a Prefetcher.
+    '''
+    def __init__(self, data_dir, batch_size, seed=1234):
+        # util pulls in theano, only needed once a provider is built
+        from util import stochastic_binarize
+        self._binarize = stochastic_binarize
+        self.data = load_mnist(data_dir)
+        self.batch_size = batch_size
+        self.rng = np.random.RandomState(seed)
+        self.seed = seed
+        n_pixels = self.data['train'].shape[1]
+        # scratch buffer of the pixel probabilities, never yielded
+        self._probs = np.empty((batch_size, n_pixels), dtype='float32')
+
+    def _iter_data(self, images, order, rng):
+        for i in range(0, len(order) - self.batch_size + 1, self.batch_size):
+            # sorted indices read the memory map front to back
+            idx = np.sort(order[i:i + self.batch_size])
+            np.multiply(images[idx], np.float32(1. / 255), out=self._probs)
+            self._binarize(self._probs, out=self._probs, rng=rng)
+            x = self._probs.T.astype('int64')
+            yield x, x.copy(), np.ones(x.shape, dtype='float32')
+
+    def get_train_batch(self):
+        images = self.data['train']
+        return self._iter_data(images, self.rng.permutation(len(images)), self.rng)
+
+    def get_valid_batch(self):
+        images = self.data['valid']
+        return self._iter_data(images, np.arange(len(images)),
+                               np.random.RandomState(self.seed + 1))
+
+    def get_test_batch(self):
+        images = self.data['test']
+        return self._iter_data(images, np.arange(len(images)),
+                               np.random.RandomState(self.seed + 2))
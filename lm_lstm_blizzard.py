@@ -15,8 +15,7 @@ import warnings
 import time
 
 from collections import OrderedDict
-from blizzard import Blizzard_tbptt
-from util import Iterator
+from blizzard import Blizzard_tbptt, TBPTTIterator
 #from char_data_iterator import TextIterator
 
 profile = False
@@ -196,77 +195,6 @@ def concatenate(tensor_list, axis=0):
     return out
 
 
-class TimitData():
-    def __init__(self, fn, batch_size):
-        import numpy as np
-        data = np.load(fn)
-
-        ####
-        # IMPORTANT: u_train is the input and x_train is the target.
-        ##
-        u_train, x_train = data['u_train'], data['x_train']
-        u_valid, x_valid = data['u_valid'], data['x_valid']
-        (u_test, x_test, mask_test) = data['u_test'],  data['x_test'], data['mask_test']
-
-        # assert u_test.shape[0] == 1680
-        # assert x_test.shape[0] == 1680
-        # assert mask_test.shape[0] == 1680
-
-        self.u_train = u_train
-        self.x_train = x_train
-        self.u_valid = u_valid
-        self.x_valid = x_valid
-
-        # make multiple of batchsize
-        n_test_padded = ((u_test.shape[0] // batch_size) + 1)*batch_size
-        assert n_test_padded > u_test.shape[0]
-        pad = n_test_padded - u_test.shape[0]
-        u_test = np.pad(u_test, ((0, pad), (0, 0), (0, 0)), mode='constant')
-        x_test = np.pad(x_test, ((0, pad), (0, 0), (0, 0)), mode='constant')
-        mask_test = np.pad(mask_test, ((0, pad), (0, 0)), mode='constant')
-        self.u_test = u_test
-        self.x_test = x_test
-        self.mask_test = mask_test
-
-        self.n_train = u_train.shape[0]
-        self.n_valid = u_valid.shape[0]
-        self.n_test = u_test.shape[0]
-        self.batch_size = batch_size
-
-        print("TRAINING SAMPLES LOADED", self.u_train.shape)
-        print("TEST SAMPLES LOADED", self.u_test.shape)
-        print("VALID SAMPLES LOADED", self.u_valid.shape)
-        print("TEST AVG LEN        ", np.mean(self.mask_test.sum(axis=1)) * 200)
-        # test that x and u are correctly shifted
-        assert np.sum(self.u_train[:, 1:] - self.x_train[:, :-1]) == 0.0
-        assert np.sum(self.u_valid[:, 1:] - self.x_valid[:, :-1]) == 0.0
-        for row in range(self.u_test.shape[0]):
-            l = int(self.mask_test[row].sum())
-            if l > 0:  # if l is zero the sequence is fully padded.
-                assert np.sum(self.u_test[row, 1:l] -
-                              self.x_test[row, :l-1]) == 0.0, row
-
-    def _iter_data(self, u, x, mask=None):
-        # IMPORTANT: In SRNN (where the data come from) u refers to the input whereas x, to the target.
-        indices = range(len(u))
-        for idx in chunk(indices, n=self.batch_size):
-            u_batch, x_batch = u[idx], x[idx]
-            if mask is None:
-                mask_batch = np.ones((x_batch.shape[0], x_batch.shape[1]), dtype='float32')
-            else:
-                mask_batch = mask[idx]
-            yield u_batch, x_batch, mask_batch
-
-    def get_train_batch(self):
-        return iter(self._iter_data(self.u_train, self.x_train))
-
-    def get_valid_batch(self):
-        return iter(self._iter_data(self.u_valid, self.x_valid))
-
-    def get_test_batch(self):
-        return iter(self._iter_data(self.u_test, self.x_test, mask=self.mask_test))
-
-
 # feedforward layer: affine transformation + point-wise nonlinearity
 def param_init_fflayer(options, params, prefix='ff', nin=None, nout=None,
                        ortho=True):
@@ -485,13 +413,8 @@ def latent_lstm_layer(
             decoder_mus = tensor.dot(tild_z_t, gen_mus_w) + gen_mus_b
             decoder_mu, decoder_sigma = decoder_mus[:, :d_.shape[1]], decoder_mus[:, d_.shape[1]:]
             decoder_mu = tensor.tanh(decoder_mu)
-<<<<<<< HEAD
             decoder_mu = T.clip(decoder_mu, -8., 8.)
             decoder_sigma = T.clip(decoder_sigma, -8., 8.)
-=======
-            decoder_mu = T.clip(decoder_mu, -10., 10.)
-            decoder_sigma = T.clip(decoder_sigma, -10., 10.)
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
             disc_d_ = theano.gradient.disconnected_grad(d_)
             recon_cost = (tensor.exp(0.5 * decoder_sigma) + tensor.sqr(disc_d_ - decoder_mu)/(2 * tensor.sqr(tensor.exp(0.5 * decoder_sigma))))
             recon_cost = tensor.sum(recon_cost, axis=-1)
@@ -555,12 +478,9 @@ def init_params(options):
     params = get_layer('ff')[0](options, params, prefix='ff_out_prev',
                                 nin=options['dim_proj'],
                                 nout=options['dim'], ortho=False)
-<<<<<<< HEAD
     params = get_layer('ff')[0](options, params, prefix='ff_out_z',
                                 nin=options['dim_z'],
                                 nout=options['dim'], ortho=False)
-=======
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
     params = get_layer('ff')[0](options, params, prefix='ff_out_mus',
                                 nin=options['dim'],
                                 nout=2 * options['dim_input'],
@@ -602,23 +522,9 @@ def init_params(options):
 
 def build_rev_model(tparams, options, x, y, x_mask):
     # for the backward rnn, we just need to invert x and x_mask
-<<<<<<< HEAD
     xr = x[::-1]
     yr = y[::-1]
     xr_mask = x_mask[::-1]
-=======
-    # concatenate first x and all targets y
-    # x = [x1, x2, x3]
-    # y = [x2, x3, x4]
-    xc = tensor.concatenate([x[:1, :, :], y], axis=0)
-    # xc = [x1, x2, x3, x4]
-    xc_mask = tensor.concatenate([tensor.alloc(1, 1, x_mask.shape[1]), x_mask], axis=0)
-    # xc_mask = [1, 1, 1, 0]
-    # xr = [x4, x3, x2, x1]
-    xr = xc[::-1]
-    # xr_mask = [0, 1, 1, 1]
-    xr_mask = xc_mask[::-1]
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
 
     xr_emb = get_layer('ff')[1](tparams, xr, options, prefix='ff_in_lstm_r', activ='lrelu')
     (states_rev, _), updates_rev = get_layer(options['encoder'])[1](tparams, xr_emb, options, prefix='encoder_r', mask=xr_mask)
@@ -627,7 +533,6 @@ def build_rev_model(tparams, options, x, y, x_mask):
     out = lrelu(out_lstm + out_prev)
     out_mus = get_layer('ff')[1](tparams, out, options, prefix='ff_out_mus_r', activ='linear')
     out_mu, out_logvar = out_mus[:, :, :options['dim_input']], out_mus[:, :, options['dim_input']:]
-<<<<<<< HEAD
     out_mu = T.clip(out_mu, -8., 8.)
     out_logvar = T.clip(out_logvar, -8., 8.)
 
@@ -637,51 +542,25 @@ def build_rev_model(tparams, options, x, y, x_mask):
     nll_rev = -log_p_y                    # NLL
     nll_rev = (nll_rev * xr_mask).sum(0)
     return nll_rev, states_rev[::-1], updates_rev
-=======
-    # clip reverse prediction
-    out_mu = T.clip(out_mu, -10., 10.)
-    out_logvar = T.clip(out_logvar, -10., 10.)
-
-    # shift mus for prediction [o4, o3, o2]
-    # targets are [x3, x2, x1]
-    out_mu = out_mu[:-1]
-    out_logvar = out_logvar[:-1]
-    targets = xr[1:]
-    targets_mask = xr_mask[1:]
-    # states_rev = [s4, s3, s2, s1]
-    # cut first state out (info about x4 is in s3)
-    # posterior sees (s1, s2, s3) in order to predict x2, x3, x4
-    states_rev = states_rev[1:][::-1]
-    # ...
-    assert xr_mask.ndim == 2
-    assert xr.ndim == 3
-    log_p_y = log_prob_gaussian(targets, mean=out_mu, log_var=out_logvar)
-    log_p_y = T.sum(log_p_y, axis=-1)     # Sum over output dim.
-    nll_rev = -log_p_y                    # NLL
-    nll_rev = (nll_rev * targets_mask).sum(0)
-    return nll_rev, states_rev, updates_rev
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
 
 
 # build a training model
-def build_gen_model(tparams, options, x, y, x_mask, zmuv, states_rev):
+def build_gen_model(tparams, options, x, y, x_mask, zmuv, states_rev,
+                    init_state=None, init_memory=None):
     # disconnecting reconstruction gradient from going in the backward encoder
     x_emb = get_layer('ff')[1](tparams, x, options, prefix='ff_in_lstm', activ='lrelu')
     rvals, updates_gen = get_layer('latent_lstm')[1](
         tparams, state_below=x_emb, options=options,
         prefix='encoder', mask=x_mask, gaussian_s=zmuv,
-        back_states=states_rev)
+        back_states=states_rev, init_state=init_state,
+        init_memory=init_memory)
 
     states_gen, z, kld, rec_cost_rev = rvals[0], rvals[2], rvals[3], rvals[4]
     # Compute parameters of the output distribution
     out_lstm = get_layer('ff')[1](tparams, states_gen, options, prefix='ff_out_lstm', activ='linear')
     out_prev = get_layer('ff')[1](tparams, x_emb, options, prefix='ff_out_prev', activ='linear')
-<<<<<<< HEAD
     out_z = get_layer('ff')[1](tparams, z, options, prefix='ff_out_z', activ='linear')
     out = lrelu(out_lstm + out_prev + out_z)
-=======
-    out = lrelu(out_lstm + out_prev)
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
     out_mus = get_layer('ff')[1](tparams, out, options, prefix='ff_out_mus', activ='linear')
     out_mu, out_logvar = out_mus[:, :, :options['dim_input']], out_mus[:, :, options['dim_input']:]
     out_mu = T.clip(out_mu, -8., 8.)
@@ -694,7 +573,9 @@ def build_gen_model(tparams, options, x, y, x_mask, zmuv, states_rev):
     nll_gen = (nll_gen * x_mask).sum(0)
     kld = (kld * x_mask).sum(0)
     rec_cost_rev = (rec_cost_rev * x_mask).sum(0)
-    return nll_gen, states_gen, kld, rec_cost_rev, updates_gen
+    # final h and c, to start the next segment of the same streams
+    last_state = [rvals[0][-1], rvals[1][-1]]
+    return nll_gen, states_gen, kld, rec_cost_rev, updates_gen, last_state
 
 
 def ELBOcost(rec_cost, kld, kld_weight=1.):
@@ -707,24 +588,15 @@ def pred_probs(f_log_probs, options, data, source='valid'):
     rvals = []
     n_done = 0
 
-<<<<<<< HEAD
-    #next_batch = (lambda: data.get_valid_batch()) \
-    #    if source == 'valid' else (lambda: data.get_test_batch())
-    #for x, y, x_mask in next_batch():
-        #x = x.transpose(1, 0, 2)
-        #y = y.transpose(1, 0, 2)
-        #x_mask = x_mask.transpose(1, 0)
-=======
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
-    for data_ in data:
-        x = data_[0][0]
-        y = data_[1][0]
-        x_mask = np.ones((x.shape[0], x.shape[1]), dtype='float32')
+    for x, y, x_mask, reset in data:
+        if reset:
+            h = numpy.zeros((x.shape[1], options['dim']), dtype='float32')
+            c = numpy.zeros((x.shape[1], options['dim']), dtype='float32')
         n_done += x.shape[1]
 
         zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(
             x.shape[0], x.shape[1], options['dim_z'])).astype('float32')
-        elbo = f_log_probs(x, y, x_mask, zmuv)
+        elbo, h, c = f_log_probs(x, y, x_mask, zmuv, h, c)
         for val in elbo:
             rvals.append(val)
     return numpy.array(rvals).mean()
@@ -777,7 +649,9 @@ def train(dim_input=200,  # input vector dimensionality
           reload_=False,
           kl_start=0.2,
           weight_aux=0.,
-          kl_rate=0.0003):
+          kl_rate=0.0003,
+          tbptt_streams=128,  # streams of the TBPTT file, the actual batch size
+          reset_every=None):  # also zero the carried state every that many segments
 
     prior_hidden = dim
     dim_z = 256
@@ -786,10 +660,6 @@ def train(dim_input=200,  # input vector dimensionality
 
     desc = saveto + 'seed_' + str(seed) + '_model_' + str(weight_aux) + '_weight_aux_' +  str(kl_start) + '_kl_Start_' + str(kl_rate) +  '_kl_rate_log.txt'
     opts = saveto + 'seed_' + str(seed) + '_model_' + str(weight_aux) + '_weight_aux_' +  str(kl_start) + '_kl_Start_' + str(kl_rate) +  '_kl_rate_opts.pkl'
-<<<<<<< HEAD
-=======
-    model_file = saveto + 'seed_' + str(seed) + '_model_' + str(weight_aux) + '_weight_aux_' +  str(kl_start) + '_kl_Start_' + str(kl_rate) +  '_kl_rate_model.npz'
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
 
     print(desc)
 
@@ -798,7 +668,6 @@ def train(dim_input=200,  # input vector dimensionality
     pkl.dump(model_options, open(opts, 'wb'))
     log_file = open(desc, 'w')
 
-<<<<<<< HEAD
     #data = TimitData("timit_raw_batchsize64_seqlen40.npz", batch_size=model_options['batch_size'])
 
     x_dim = 200
@@ -808,13 +677,6 @@ def train(dim_input=200,  # input vector dimensionality
 
 
 
-=======
-
-    x_dim = 200
-    data_path = '/scratch/macote/blizzard_unseg/'
-    file_name = 'blizzard_unseg_tbptt'
-
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
     normal_params = np.load(data_path + file_name + '_normal.npz')
     X_mean = normal_params['X_mean']
     X_std = normal_params['X_std']
@@ -822,6 +684,7 @@ def train(dim_input=200,  # input vector dimensionality
                                 path=data_path,
                                 frame_size=x_dim,
                                 file_name=file_name,
+                                batch_size=tbptt_streams,
                                 X_mean=X_mean,
                                 X_std=X_std)
 
@@ -829,14 +692,13 @@ def train(dim_input=200,  # input vector dimensionality
                                 path=data_path,
                                 frame_size=x_dim,
                                 file_name=file_name,
+                                batch_size=tbptt_streams,
                                 X_mean=X_mean,
                                 X_std=X_std)
-<<<<<<< HEAD
-=======
-
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
-    train_d_ = Iterator(train_data, batch_size, start=0, end=2040064)
-    valid_d_ = Iterator(valid_data, batch_size, start=2040064, end=2152704)
+    # consecutive segments of the same streams, the state is carried over
+    train_d_ = TBPTTIterator(train_data, start=0, end=2040064,
+                             reset_every=reset_every)
+    valid_d_ = TBPTTIterator(valid_data, start=2040064, end=2152704)
     print('Building model')
     params = init_params(model_options)
     tparams = init_tparams(params)
@@ -845,14 +707,17 @@ def train(dim_input=200,  # input vector dimensionality
     y = tensor.tensor3('y')
     x_mask = tensor.matrix('x_mask')
     zmuv = tensor.tensor3('zmuv')
+    init_state = tensor.matrix('init_state')
+    init_memory = tensor.matrix('init_memory')
     weight_f = tensor.scalar('weight_f')
     lr = tensor.scalar('lr')
 
     # build the symbolic computational graph
     nll_rev, states_rev, updates_rev = \
         build_rev_model(tparams, model_options, x, y, x_mask)
-    nll_gen, states_gen, kld, rec_cost_rev, updates_gen = \
-        build_gen_model(tparams, model_options, x, y, x_mask, zmuv, states_rev)
+    nll_gen, states_gen, kld, rec_cost_rev, updates_gen, last_state = \
+        build_gen_model(tparams, model_options, x, y, x_mask, zmuv, states_rev,
+                        init_state=init_state, init_memory=init_memory)
 
     vae_cost = ELBOcost(nll_gen, kld, kld_weight=weight_f).mean()
     elbo_cost = ELBOcost(nll_gen, kld, kld_weight=1.).mean()
@@ -863,9 +728,9 @@ def train(dim_input=200,  # input vector dimensionality
     kld_cost = kld.mean()
 
     print('Building f_log_probs...')
-    inps = [x, y, x_mask, zmuv, weight_f]
+    inps = [x, y, x_mask, zmuv, init_state, init_memory, weight_f]
     f_log_probs = theano.function(
-        inps[:-1], ELBOcost(nll_gen, kld, kld_weight=1.),
+        inps[:-1], [ELBOcost(nll_gen, kld, kld_weight=1.)] + last_state,
         updates=(updates_gen + updates_rev), profile=profile)
     print('Done')
 
@@ -873,17 +738,13 @@ def train(dim_input=200,  # input vector dimensionality
     grads = tensor.grad(tot_cost, itemlist(tparams))
     print('Done')
 
-<<<<<<< HEAD
     all_grads, non_finite, clipped = gradient_clipping(grads, tparams, 10.)
-=======
-    all_grads, non_finite, clipped = gradient_clipping(grads, tparams, 5.)
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
     # update function
     all_gshared = [theano.shared(p.get_value() * 0., name='%s_grad' % k)
                    for k, p in tparams.iteritems()]
     all_gsup = [(gs, g) for gs, g in zip(all_gshared, all_grads)]
     # forward pass + gradients
-    outputs = [vae_cost, aux_cost, tot_cost, kld_cost, elbo_cost, nll_rev_cost, nll_gen_cost, non_finite]
+    outputs = [vae_cost, aux_cost, tot_cost, kld_cost, elbo_cost, nll_rev_cost, nll_gen_cost, non_finite] + last_state
     print('Fprop')
     f_prop = theano.function(inps, outputs, updates=all_gsup)
     print('Fupdate')
@@ -909,21 +770,11 @@ def train(dim_input=200,  # input vector dimensionality
         n_samples = 0
         tr_costs = [[], [], [], [], [], [], []]
 
-<<<<<<< HEAD
-        #for x, y, x_mask in data.get_train_batch():
-=======
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
-        for data_ in train_d_:
-            x = data_[0][0]
-            y = data_[1][0]
-            x_mask = np.ones((x.shape[0], x.shape[1]), dtype='float32')
-<<<<<<< HEAD
-            # Transpose data to have the time steps on dimension 0.
-            #x = x.transpose(1, 0, 2)
-            #y = y.transpose(1, 0, 2)
-            #x_mask = x_mask.transpose(1, 0)
-=======
->>>>>>> 2cedae0253b87dec5dcb6e39d36bf2d811884420
+        for x, y, x_mask, reset in train_d_:
+            # the streams start over, forget the carried state
+            if reset:
+                h_np = numpy.zeros((x.shape[1], dim), dtype='float32')
+                c_np = numpy.zeros((x.shape[1], dim), dtype='float32')
 
             n_samples += x.shape[1]
             uidx += 1
@@ -933,12 +784,15 @@ def train(dim_input=200,  # input vector dimensionality
             ud_start = time.time()
             # compute cost, grads and copy grads to shared variables
             zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(x.shape[0], x.shape[1], model_options['dim_z'])).astype('float32')
-            vae_cost_np, aux_cost_np, tot_cost_np, kld_cost_np, elbo_cost_np, nll_rev_cost_np, nll_gen_cost_np, not_finite_np = \
-                f_prop(x, y, x_mask, zmuv, np.float32(kl_start))
+            vae_cost_np, aux_cost_np, tot_cost_np, kld_cost_np, elbo_cost_np, nll_rev_cost_np, nll_gen_cost_np, not_finite_np, h_last, c_last = \
+                f_prop(x, y, x_mask, zmuv, h_np, c_np, np.float32(kl_start))
             if numpy.isnan(tot_cost_np) or numpy.isinf(tot_cost_np) or not_finite_np:
                 print('Nan cost... skipping')
+                h_np = numpy.zeros_like(h_np)
+                c_np = numpy.zeros_like(c_np)
                 continue
             else:
+                h_np, c_np = h_last, c_last
                 f_update(numpy.float32(lrate))
 
             # update costs
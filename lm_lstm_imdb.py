@@ -9,6 +9,7 @@ import theano.tensor as T
 import theano.tensor as tensor
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 from lm_data import IMDB_JMARS
+from util import SyntheticSequences
 
 import cPickle as pkl
 import numpy
@@ -19,6 +20,7 @@ import warnings
 import time
 import cPickle
 from philly_utils import print_philly_hb
+from prefetch import Prefetcher
 from collections import OrderedDict
 
 profile = False
@@ -1073,7 +1075,9 @@ def train(dim_input=200,  # input vector dimensionality
           num_nf_layers=0,
           kl_start=0.2,
           weight_aux=0.,
-          kl_rate=0.0003):
+          kl_rate=0.0003,
+          bucketed=False,
+          synthetic=False):  # random token sequences instead of the reviews
 
     dim_z = 64
     dim_mlp = dim
@@ -1089,8 +1093,12 @@ def train(dim_input=200,  # input vector dimensionality
 
     # Model options
     model_options = locals().copy()
-    data = IMDB_JMARS(data_dir, seq_len=16,
-            batch_size=batch_size, topk=16000)
+    if synthetic:
+        data = SyntheticSequences(n_words=16000, batch_size=batch_size,
+                                  seq_len=16, min_len=5)
+    else:
+        data = IMDB_JMARS(data_dir, seq_len=16,
+                batch_size=batch_size, topk=16000, bucketed=bucketed)
     dim_input = data.voc_size
     model_options['dim_input'] = dim_input
 
@@ -1203,34 +1211,40 @@ def train(dim_input=200,  # input vector dimensionality
         num_train_batches += 1.
     num_total_batches = num_train_batches * max_epochs
 
+    def prepare(batch):
+        x, y, x_mask = batch
+        # Repeat if we're using IWAE
+        if model_options['use_iwae']:
+            x = numpy.repeat(x, num_iwae_samps_train, axis=0)
+            y = numpy.repeat(y, num_iwae_samps_train, axis=0)
+            x_mask = numpy.repeat(x_mask, num_iwae_samps_train, axis=0)
+
+        # Transpose data to have the time steps on dimension 0.
+        x = x.transpose(1, 0).astype('int32')
+        y = y.transpose(1, 0).astype('int32')
+        x_mask = x_mask.transpose(1, 0).astype('float32')
+        n_steps = x.shape[0]
+        n_samps = x.shape[1]
+
+        zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(
+            n_steps, n_samps, model_options['dim_z'])).astype('float32')
+        return x, y, x_mask, zmuv
+
     # epochs loop
     for eidx in range(max_epochs):
         print("Epoch: {}".format(eidx))
         n_samples = 0
         tr_costs = [[], [], [], [], [], [], []]
 
-        for x, y, x_mask in data.get_train_batch():
-            # Repeat if we're using IWAE
-            if model_options['use_iwae']:
-                x = numpy.repeat(x, num_iwae_samps_train, axis=0)
-                y = numpy.repeat(y, num_iwae_samps_train, axis=0)
-                x_mask = numpy.repeat(x_mask, num_iwae_samps_train, axis=0)
-
-            # Transpose data to have the time steps on dimension 0.
-            x = x.transpose(1, 0).astype('int32')
-            y = y.transpose(1, 0).astype('int32')
-            x_mask = x_mask.transpose(1, 0).astype('float32')
-            n_steps = x.shape[0]
-            n_samps = x.shape[1]
-
+        # batches and noise are prepared in the background
+        batches = Prefetcher(data.get_train_batch(), prepare)
+        for x, y, x_mask, zmuv in batches:
             uidx += 1
             if kl_start < 1.:
                 kl_start += kl_rate
 
             ud_start = time.time()
             # compute cost, grads and copy grads to shared variables
-            zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(
-                n_steps, n_samps, model_options['dim_z'])).astype('float32')
             vae_cost_np, aux_cost_np, tot_cost_np, kld_cost_np, \
                 elbo_cost_np, nll_rev_cost_np, nll_gen_cost_np, not_finite_np = \
                 f_prop(x, y, x_mask, zmuv, np.float32(kl_start))
@@ -1262,6 +1276,13 @@ def train(dim_input=200,  # input vector dimensionality
                 log_file.write(str1 + '\n')
                 log_file.flush()
 
+        # None when the epoch produced no batch
+        padding_ratio = data.padding_ratio or 0.
+        str1 = 'Train padding ratio: {:.3f}, {}'.format(
+            padding_ratio, batches.stats())
+        print(str1)
+        log_file.write(str1 + '\n')
+
         print('Starting validation...')
         train_err = pred_probs(f_log_probs, f_iwae_eval, model_options, data, source='train')
         str1 = 'Train ELBO: {:.2f}, IWAE: {:.2f}'.format(train_err[0], train_err[1])
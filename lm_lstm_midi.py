@@ -18,6 +18,8 @@ import warnings
 import time
 
 from collections import OrderedDict
+from lm_data import PianoRollData
+from prefetch import Prefetcher
 
 #from char_data_iterator import TextIterator
 
@@ -202,78 +204,6 @@ def concatenate(tensor_list, axis=0):
     return out
 
 
-class TimitData():
-    def __init__(self, fn, batch_size):
-        import numpy as np
-        print 'Loading ', fn
-        data = np.load(fn)
-
-        ####
-        # IMPORTANT: u_train is the input and x_train is the target.
-        ##
-        u_train, x_train = data['u_train'], data['x_train']
-        u_valid, x_valid = data['u_valid'], data['x_valid']
-        (u_test, x_test, mask_test) = data['u_test'],  data['x_test'], data['mask_test']
-
-        # assert u_test.shape[0] == 1680
-        # assert x_test.shape[0] == 1680
-        # assert mask_test.shape[0] == 1680
-
-        self.u_train = u_train
-        self.x_train = x_train
-        self.u_valid = u_valid
-        self.x_valid = x_valid
-
-        # make multiple of batchsize
-        n_test_padded = ((u_test.shape[0] // batch_size) + 1)*batch_size
-        assert n_test_padded > u_test.shape[0]
-        pad = n_test_padded - u_test.shape[0]
-        u_test = np.pad(u_test, ((0, pad), (0, 0), (0, 0)), mode='constant')
-        x_test = np.pad(x_test, ((0, pad), (0, 0), (0, 0)), mode='constant')
-        mask_test = np.pad(mask_test, ((0, pad), (0, 0)), mode='constant')
-        self.u_test = u_test
-        self.x_test = x_test
-        self.mask_test = mask_test
-
-        self.n_train = u_train.shape[0]
-        self.n_valid = u_valid.shape[0]
-        self.n_test = u_test.shape[0]
-        self.batch_size = batch_size
-
-        print("TRAINING SAMPLES LOADED", self.u_train.shape)
-        print("TEST SAMPLES LOADED", self.u_test.shape)
-        print("VALID SAMPLES LOADED", self.u_valid.shape)
-        print("TEST AVG LEN        ", np.mean(self.mask_test.sum(axis=1)) * 200)
-        # test that x and u are correctly shifted
-        assert np.sum(self.u_train[:, 1:] - self.x_train[:, :-1]) == 0.0
-        assert np.sum(self.u_valid[:, 1:] - self.x_valid[:, :-1]) == 0.0
-        for row in range(self.u_test.shape[0]):
-            l = int(self.mask_test[row].sum())
-            if l > 0:  # if l is zero the sequence is fully padded.
-                assert np.sum(self.u_test[row, 1:l] -
-                              self.x_test[row, :l-1]) == 0.0, row
-
-    def _iter_data(self, u, x, mask=None):
-        # IMPORTANT: In SRNN (where the data come from) u refers to the input whereas x, to the target.
-        indices = range(len(u))
-        for idx in chunk(indices, n=self.batch_size):
-            u_batch, x_batch = u[idx], x[idx]
-            if mask is None:
-                mask_batch = np.ones((x_batch.shape[0], x_batch.shape[1]), dtype='float32')
-            else:
-                mask_batch = mask[idx]
-            yield u_batch, x_batch, mask_batch
-
-    def get_train_batch(self):
-        return iter(self._iter_data(self.u_train, self.x_train))
-
-    def get_valid_batch(self):
-        return iter(self._iter_data(self.u_valid, self.x_valid))
-
-    def get_test_batch(self):
-        return iter(self._iter_data(self.u_test, self.x_test, mask=self.mask_test))
-
-
 # feedforward layer: affine transformation + point-wise nonlinearity
 def param_init_fflayer(options, params, prefix='ff', nin=None, nout=None,
                        ortho=True):
@@ -732,7 +662,7 @@ def train(dim_input=88,  # input vector dimensionality
 
     file_midi = os.path.join('./experiments/midi/', '%s_raw_batchsize16_seqlen100.npz') % (dataset)
     print("Loading midi from %s" % file_midi)
-    data = TimitData(file_midi, batch_size=model_options['batch_size'])
+    data = PianoRollData(file_midi, batch_size=model_options['batch_size'], shuffle=True)
 
     print('Building model')
     params = init_params(model_options)
@@ -797,17 +727,23 @@ def train(dim_input=88,  # input vector dimensionality
     kl_start = model_options['kl_start']
     kl_rate = model_options['kl_rate']
 
+    def prepare(batch):
+        x, y, x_mask = batch
+        # Transpose data to have the time steps on dimension 0.
+        x = x.transpose(1, 0, 2)
+        y = y.transpose(1, 0, 2)
+        x_mask = x_mask.transpose(1, 0)
+        zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(x.shape[0], x.shape[1], model_options['dim_z'])).astype('float32')
+        return x, y, x_mask, zmuv
+
     for eidx in range(max_epochs):
         print("Epoch: {}".format(eidx))
         n_samples = 0
         tr_costs = [[], [], [], [], [], [], []]
 
-        for x, y, x_mask in data.get_train_batch():
-            # Transpose data to have the time steps on dimension 0.
-            x = x.transpose(1, 0, 2)
-            y = y.transpose(1, 0, 2)
-            x_mask = x_mask.transpose(1, 0)
-
+        # batches and noise are prepared in the background
+        batches = Prefetcher(data.get_train_batch(), prepare)
+        for x, y, x_mask, zmuv in batches:
             n_samples += x.shape[1]
             uidx += 1
             if kl_start < 1.:
@@ -815,7 +751,6 @@ def train(dim_input=88,  # input vector dimensionality
 
             ud_start = time.time()
             # compute cost, grads and copy grads to shared variables
-            zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(x.shape[0], x.shape[1], model_options['dim_z'])).astype('float32')
             vae_cost_np, aux_cost_np, tot_cost_np, kld_cost_np, elbo_cost_np, nll_rev_cost_np, nll_gen_cost_np, not_finite_np = \
                 f_prop(x, y, x_mask, zmuv, np.float32(kl_start))
             if numpy.isnan(tot_cost_np) or numpy.isinf(tot_cost_np) or not_finite_np:
@@ -846,6 +781,7 @@ def train(dim_input=88,  # input vector dimensionality
         if eidx in [30]:
             lrate = lrate / 2.0
 
+        print(batches.stats())
         print 'Starting validation...'
         valid_err = pred_probs(f_log_probs, model_options, data, source='valid')
         test_err = pred_probs(f_log_probs, model_options, data, source='test')
@@ -14,7 +14,7 @@ import warnings
 import time
 
 from collections import OrderedDict
-import fuel.datasets, fuel.streams, fuel.transformers, fuel.schemes
+from lm_data import MNISTData
 
 #from char_data_iterator import TextIterator
 
@@ -606,18 +606,9 @@ def pred_probs(f_log_probs, options, data, source='valid'):
     rvals = []
     n_done = 0
 
-    for something in data.get_epoch_iterator():
-        x = something[0]
-        if x is None:
-            print 'Minibatch with zero sample under length ', maxlen
-            continue
-        if x.shape[0] is not model_options['batch_size']:
-            continue
-        x = something[0].reshape((options['batch_size'], options['maxlen'])).astype('int64')
-
-        x = x.T
-        y = x
-        x_mask = np.ones((options['maxlen'], options['batch_size'])).astype('float32')
+    next_batch = (lambda: data.get_valid_batch()) \
+        if source == 'valid' else (lambda: data.get_test_batch())
+    for x, y, x_mask in next_batch():
         n_done += x.shape[1]
 
         zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(
@@ -649,28 +640,6 @@ def adam(lr, tparams, gshared, beta1=0.9, beta2=0.99, e=1e-5):
     f_update = theano.function([lr], [], updates=updates, profile=profile)
     return f_update
 
-_datasets = None
-def get_dataset(which_set):
-    global _datasets
-    if not _datasets:
-        MNIST = fuel.datasets.MNIST
-        # jump through hoops to instantiate only once and only if needed
-        _datasets = dict(
-            train=MNIST(which_sets=["train"], subset=slice(None, 50000)),
-            valid=MNIST(which_sets=["train"], subset=slice(50000, None)),
-            test=MNIST(which_sets=["test"]))
-    return _datasets[which_set]
-
-def get_stream(which_set, batch_size, num_examples=None):
-    dataset = get_dataset(which_set)
-    if num_examples is None or num_examples > dataset.num_examples:
-        num_examples = dataset.num_examples
-    stream = fuel.streams.DataStream.default_stream(
-        dataset,
-        iteration_scheme=fuel.schemes.ShuffledScheme(num_examples, batch_size))
-    return stream
-
-
 
 def train(dim_word=200,  # input vector dimensionality
           dim=2000,  # the number of GRU units
@@ -694,6 +663,7 @@ def train(dim_word=200,  # input vector dimensionality
           dataset=None,  # Not used
           valid_dataset=None,  # Not used
           dictionary=None,  # Not used
+          data_dir=None,  # where the MNIST arrays are cached, FUEL_DATA_PATH by default
           use_dropout=False,
           reload_=False,
           kl_start=0.2,
@@ -712,9 +682,9 @@ def train(dim_word=200,  # input vector dimensionality
 
 
     model_options = locals().copy()
-    train = get_stream('train', model_options['batch_size'], num_examples=None)
-    valid = get_stream('valid', model_options['batch_size'], num_examples=None)
-    test = get_stream('test', model_options['batch_size'], num_examples=None)
+    if data_dir is None:
+        data_dir = os.environ.get('FUEL_DATA_PATH', '.').split(os.pathsep)[0]
+    data = MNISTData(data_dir, model_options['batch_size'])
 
     # Model options
     pkl.dump(model_options, open(opts, 'wb'))
@@ -791,21 +761,7 @@ def train(dim_word=200,  # input vector dimensionality
         n_samples = 0
         tr_costs = [[], [], [], [], [], [], []]
 
-        for data in train.get_epoch_iterator():
-            x = data[0]
-            if x is None:
-                print 'Minibatch with zero sample under length ', maxlen
-                uidx -= 1
-                continue
-            if x.shape[0] is not model_options['batch_size']:
-                uidx -= 1
-                continue
-            x = data[0].reshape((model_options['batch_size'], model_options['maxlen'])).astype('int64')
-
-            x = x.T
-            y = x
-            x_mask = np.ones((model_options['maxlen'], model_options['batch_size'])).astype('float32')
-
+        for x, y, x_mask in data.get_train_batch():
             n_samples += x.shape[1]
             uidx += 1
             if kl_start < 1.:
@@ -845,8 +801,8 @@ def train(dim_word=200,  # input vector dimensionality
             lrate = lrate / 2.0
 
         print 'Starting validation...'
-        valid_err = pred_probs(f_log_probs, model_options, valid, source='valid')
-        test_err = pred_probs(f_log_probs, model_options, test, source='test')
+        valid_err = pred_probs(f_log_probs, model_options, data, source='valid')
+        test_err = pred_probs(f_log_probs, model_options, data, source='test')
         history_errs.append(valid_err)
         str1 = 'Valid/Test ELBO: {:.2f}, {:.2f}'.format(valid_err, test_err)
         print(str1)
@@ -857,8 +813,8 @@ def train(dim_word=200,  # input vector dimensionality
             print('Finishing after %d iterations!' % uidx)
             break
 
-    valid_err = pred_probs(f_log_probs, model_options, valid, source='valid')
-    test_err = pred_probs(f_log_probs, model_options, test, source='test')
+    valid_err = pred_probs(f_log_probs, model_options, data, source='valid')
+    test_err = pred_probs(f_log_probs, model_options, data, source='test')
     str1 = 'Valid/Test ELBO: {:.2f}, {:.2f}'.format(valid_err, test_err)
     print(str1)
     log_file.write(str1 + '\n')
@@ -19,6 +19,7 @@ import warnings
 import time
 
 from collections import OrderedDict
+from prefetch import Prefetcher
 
 #from char_data_iterator import TextIterator
 
@@ -828,17 +829,23 @@ def train(dim_input=200,  # input vector dimensionality
     kl_start = model_options['kl_start']
     kl_rate = model_options['kl_rate']
 
+    def prepare(batch):
+        x, y, x_mask = batch
+        # Transpose data to have the time steps on dimension 0.
+        x = x.transpose(1, 0).astype('int32')
+        y = y.transpose(1, 0).astype('int32')
+        x_mask = x_mask.transpose(1, 0).astype('float32')
+        zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(x.shape[0], x.shape[1], model_options['dim_z'])).astype('float32')
+        return x, y, x_mask, zmuv
+
     for eidx in range(max_epochs):
         print("Epoch: {}".format(eidx))
         n_samples = 0
         tr_costs = [[], [], [], [], [], [], []]
 
-        for x, y, x_mask in data.get_train_batch():
-            # Transpose data to have the time steps on dimension 0.
-            x = x.transpose(1, 0).astype('int32')
-            y = y.transpose(1, 0).astype('int32')
-            x_mask = x_mask.transpose(1, 0).astype('float32')
-
+        # batches and noise are prepared in the background
+        batches = Prefetcher(data.get_train_batch(), prepare)
+        for x, y, x_mask, zmuv in batches:
             n_samples += x.shape[1]
             uidx += 1
             if kl_start < 1.:
@@ -846,7 +853,6 @@ def train(dim_input=200,  # input vector dimensionality
 
             ud_start = time.time()
             # compute cost, grads and copy grads to shared variables
-            zmuv = numpy.random.normal(loc=0.0, scale=1.0, size=(x.shape[0], x.shape[1], model_options['dim_z'])).astype('float32')
             vae_cost_np, aux_cost_np, tot_cost_np, kld_cost_np, \
                 elbo_cost_np, nll_rev_cost_np, nll_gen_cost_np, not_finite_np = \
                 f_prop(x, y, x_mask, zmuv, np.float32(kl_start))
@@ -878,6 +884,7 @@ def train(dim_input=200,  # input vector dimensionality
         if eidx in [10, 20]:
             lrate = lrate / 2.0
 
+        print(batches.stats())
         print 'Starting validation...'
         valid_err = pred_probs(f_log_probs, model_options, data, source='valid')
         test_err = pred_probs(f_log_probs, model_options, data, source='test')
@@ -0,0 +1,89 @@
+import sys
+import threading
+
+import six
+from six.moves import queue
+
+_END = object()
+
+
+class _Failure(object):
+    """ Exception raised in the worker, re-raised in the consumer. """
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class Prefetcher(object):
+    """
+    Iterate over a batch generator from a background thread.
+
+    The worker pulls batches from `batches`, applies `prepare` to each of
+    them (transpose, casts, noise...) and puts the results on a queue of at
+    most `max_queue` items, so that data preparation overlaps with the
+    Theano calls of the consumer.
+    Parameters
+    ----------
+    batches   : iterable, e.g. the generator returned by get_train_batch()
+    prepare   : callable applied to every batch in the worker thread
+    max_queue : integer
+        Number of prepared batches kept ahead of the consumer
+    Notes
+    -----
+    `starved` counts the batches the consumer had to wait for, out of
+    `n_batches` consumed so far.
+    """
+    def __init__(self, batches, prepare=None, max_queue=8):
+        self.batches = batches
+        self.prepare = prepare
+        self.queue = queue.Queue(max_queue)
+        self.starved = 0
+        self.n_batches = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for batch in self.batches:
+                if self.prepare is not None:
+                    batch = self.prepare(batch)
+                if not self._put(batch):
+                    return
+        except Exception:
+            self._put(_Failure(sys.exc_info()))
+            return
+        self._put(_END)
+
+    def __iter__(self):
+        try:
+            while True:
+                waited = self.queue.empty()
+                item = self.queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    six.reraise(*item.exc_info)
+                self.starved += waited
+                self.n_batches += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """ Stop the worker, e.g. when leaving the loop early. """
+        self._stop.set()
+        self._thread.join()
+
+    def stats(self):
+        return 'Prefetch starved on {} / {} batches'.format(
+            self.starved, self.n_batches)
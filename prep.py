@@ -3,37 +3,123 @@ import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.fftpack
 import scipy.signal
 import theano.tensor as T
 
+from ragged_array import RaggedArray
 from temporal_series import TemporalSeries
 from util import segment_axis, tolist, totuple
 
 
+def _unpack(X):
+    """
+    Flat values of X and the offsets of its sequences
+    Returns
+    -------
+    values  : ndArray
+        X itself for a dense batch, the concatenated sequences otherwise
+    offsets : ndArray, None for a dense batch
+    kind    : 'dense', 'ragged' or 'list'
+    """
+    if isinstance(X, RaggedArray):
+        return X.tokens, X.offsets, 'ragged'
+    if isinstance(X, np.ndarray) and X.dtype != object:
+        return X, None, 'dense'
+    lengths = [len(x) for x in X]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype('int64')
+    values = np.concatenate([np.asarray(x) for x in X]) if len(X) else np.zeros(0)
+    return values, offsets, 'list'
+
+
+def _pack(values, offsets, kind):
+    """ Inverse of _unpack. """
+    if kind == 'ragged':
+        return RaggedArray(values, offsets)
+    if kind == 'dense':
+        return values
+    return np.split(values, offsets[1:-1])
+
+
+def _float_dtype(dtype, complex=False):
+    """ dtype of the results: float inputs keep their precision. """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'fc':
+        dtype = np.dtype('float64')
+    if complex:
+        return np.result_type(dtype, np.complex64)
+    return np.empty(0, dtype).real.dtype
+
+
+def _segment_sums(values, offsets):
+    """ Sum of every sequence of a flat buffer. """
+    lengths = np.diff(offsets)
+    sums = np.zeros(len(lengths), dtype=values.dtype)
+    nonempty = lengths > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+    return sums
+
+
+def _map_by_length(values, offsets, fn, out_length, dtype):
+    """
+    Apply `fn` to sequences grouped by length, each group as one
+    (n_sequences, length) array transformed along its last axis
+    Parameters
+    ----------
+    fn         : callable (rows, length) -> (n_sequences, new length)
+    out_length : callable lengths -> new lengths
+    """
+    lengths = np.diff(offsets)
+    new_offsets = np.concatenate([[0], np.cumsum(out_length(lengths))]).astype('int64')
+    out = np.zeros(new_offsets[-1], dtype=dtype)
+    for n in np.unique(lengths):
+        if n == 0:
+            continue
+        idx = np.flatnonzero(lengths == n)
+        rows = values[offsets[idx][:, None] + np.arange(n)]
+        res = fn(rows, n)
+        out[new_offsets[idx][:, None] + np.arange(res.shape[1])] = res
+    return out, new_offsets
+
+
 class SequentialPrepMixin(object):
     """
     Preprocessing mixin for sequential data
+    Notes
+    -----
+    X is either a dense batch (ndArray, sequences along the first axis),
+    a RaggedArray (flat buffer + offsets) or a list of sequences. Results
+    have the same form as X and float inputs keep their dtype.
     """
-    def norm_normalize(self, X, avr_norm=None):
+    def norm_normalize(self, X, avr_norm=None, out=None):
         """
         Unify the norm of each sequence in X
         Parameters
         ----------
         X       : list of lists or ndArrays
         avr_nom : Scalar
+        out     : ndArray, optional buffer for the normalized values
         """
+        values, offsets, kind = _unpack(X)
+        dtype = _float_dtype(values.dtype)
         if avr_norm is None:
-            avr_norm = 0
-            for i in range(len(X)):
-                euclidean_norm = np.sqrt(np.square(X[i].sum()))
-                X[i] /= euclidean_norm
-                avr_norm += euclidean_norm
-            avr_norm /= len(X)
+            if offsets is None:
+                sums = values.reshape(len(values), -1).sum(axis=1)
+            else:
+                sums = _segment_sums(values, offsets)
+            euclidean_norm = np.sqrt(np.square(sums)).astype(dtype)
+            avr_norm = euclidean_norm.mean()
+            if offsets is None:
+                scale = euclidean_norm.reshape((-1,) + (1,) * (values.ndim - 1))
+            else:
+                scale = np.repeat(euclidean_norm, np.diff(offsets))
         else:
-            X = [x[i] / avr_norm for x in X]
-        return X, avr_norm
+            scale = dtype.type(avr_norm)
+        values = np.divide(values, scale, out=out, dtype=dtype)
+        return _pack(values, offsets, kind), avr_norm
 
-    def global_normalize(self, X, X_mean=None, X_std=None):
+    def global_normalize(self, X, X_mean=None, X_std=None, out=None):
         """
         Globally normalize X into zero mean and unit variance
         Parameters
@@ -41,22 +127,24 @@ class SequentialPrepMixin(object):
         X      : list of lists or ndArrays
         X_mean : Scalar
         X_std  : Scalar
+        out    : ndArray, optional buffer for the normalized values
         Notes
         -----
         Compute varaince using the relation
         >>> Var(X) = E[X^2] - E[X]^2
+        The moments are accumulated in float64.
         """
+        values, offsets, kind = _unpack(X)
+        dtype = _float_dtype(values.dtype)
         if X_mean is None or X_std is None:
-            X_len = np.array([len(x) for x in X]).sum()
-            X_mean = np.array([x.sum() for x in X]).sum() / X_len
-            X_sqr = np.array([(x**2).sum() for x in X]).sum() / X_len
+            X_mean = values.mean(dtype='float64')
+            X_sqr = np.square(values, dtype='float64').mean()
             X_std = np.sqrt(X_sqr - X_mean**2)
-            X = (X - X_mean) / X_std
-        else:
-            X = (X - X_mean) / X_std
-        return (X, X_mean, X_std)
+        values = np.subtract(values, dtype.type(X_mean), out=out, dtype=dtype)
+        values /= dtype.type(X_std)
+        return (_pack(values, offsets, kind), X_mean, X_std)
 
-    def standardize(self, X, X_max=None, X_min=None):
+    def standardize(self, X, X_max=None, X_min=None, out=None):
         """
         Standardize X such that X \in [0, 1]
         Parameters
@@ -64,14 +152,36 @@ class SequentialPrepMixin(object):
         X     : list of lists or ndArrays
         X_max : Scalar
         X_min : Scalar
+        out   : ndArray, optional buffer for the standardized values
         """
+        values, offsets, kind = _unpack(X)
+        dtype = _float_dtype(values.dtype)
         if X_max is None or X_min is None:
-            X_max = np.array([x.max() for x in X]).max()
-            X_min = np.array([x.min() for x in X]).min()
-            X = (X - X_min) / (X_max - X_min)
-        else:
-            X = (X - X_min) / (X_max - X_min)
-        return (X, X_max, X_min)
+            X_max = values.max()
+            X_min = values.min()
+        values = np.subtract(values, dtype.type(X_min), out=out, dtype=dtype)
+        values /= dtype.type(X_max - X_min)
+        return (_pack(values, offsets, kind), X_max, X_min)
+
+    def _transform(self, X, fn, out_length=None, complex=False):
+        """
+        Apply `fn(rows, length)` along the last axis of a dense batch, or
+        to the sequences of X grouped by length
+        Notes
+        -----
+        Sequences of frames are transformed frame by frame: they keep
+        their number of frames and only their last axis changes.
+        """
+        values, offsets, kind = _unpack(X)
+        dtype = _float_dtype(values.dtype, complex)
+        if offsets is None:
+            return fn(values, values.shape[-1]).astype(dtype, copy=False)
+        if values.ndim > 1:
+            values = fn(values, values.shape[-1]).astype(dtype, copy=False)
+            return _pack(values, offsets, kind)
+        out_length = out_length or (lambda lengths: lengths)
+        values, offsets = _map_by_length(values, offsets, fn, out_length, dtype)
+        return _pack(values, offsets, kind)
 
     def numpy_rfft(self, X):
         """
@@ -80,18 +190,38 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([np.fft.rfft(x) for x in X])
-        return X
+        return self._transform(X, lambda x, n: np.fft.rfft(x, axis=-1),
+                               lambda lengths: lengths // 2 + 1, complex=True)
 
-    def numpy_irfft(self, X):
+    def numpy_irfft(self, X, lengths=None):
         """
         Apply real inverse FFT to X (numpy)
         Parameters
         ----------
-        X     : list of lists or ndArrays
+        X       : list of lists or ndArrays
+        lengths : integer or list of integers
+            Lengths of the original sequences, 2 * (n - 1) by default
         """
-        X = np.array([np.fft.irfft(x) for x in X])
-        return X
+        values, offsets, kind = _unpack(X)
+        if offsets is None or values.ndim > 1:
+            return self._transform(X, lambda x, m: np.fft.irfft(x, n=lengths, axis=-1))
+        if lengths is None:
+            lengths = 2 * (np.diff(offsets) - 1)
+
+        # sequences sharing a spectrum size may differ in original length
+        lengths = np.broadcast_to(np.asarray(lengths), (len(offsets) - 1,))
+        dtype = _float_dtype(values.dtype)
+        key = np.diff(offsets) * (lengths.max() + 1) + lengths
+        new_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype('int64')
+        out = np.zeros(new_offsets[-1], dtype=dtype)
+        for k in np.unique(key):
+            idx = np.flatnonzero(key == k)
+            m, n = np.diff(offsets)[idx[0]], lengths[idx[0]]
+            if m == 0 or n == 0:
+                continue
+            rows = values[offsets[idx][:, None] + np.arange(m)]
+            out[new_offsets[idx][:, None] + np.arange(n)] = np.fft.irfft(rows, n=n, axis=-1)
+        return _pack(out, new_offsets, kind)
 
     def rfft(self, X):
         """
@@ -100,8 +230,7 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([scipy.fftpack.rfft(x) for x in X])
-        return X
+        return self._transform(X, lambda x, n: scipy.fftpack.rfft(x, axis=-1))
 
     def irfft(self, X):
         """
@@ -110,8 +239,7 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([scipy.fftpack.irfft(x) for x in X])
-        return X
+        return self._transform(X, lambda x, n: scipy.fftpack.irfft(x, axis=-1))
 
     def stft(self, X):
         """
@@ -120,8 +248,7 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([scipy.fft(x) for x in X])
-        return X
+        return self._transform(X, lambda x, n: np.fft.fft(x, axis=-1), complex=True)
 
     def istft(self, X):
         """
@@ -130,8 +257,7 @@ class SequentialPrepMixin(object):
         ----------
         X     : list of lists or ndArrays
         """
-        X = np.array([scipy.real(scipy.ifft(x)) for x in X])
-        return X
+        return self._transform(X, lambda x, n: np.real(np.fft.ifft(x, axis=-1)))
 
     def fill_zero1D(self, x, pad_len=0, mode='righthand'):
         """
@@ -162,7 +288,7 @@ class SequentialPrepMixin(object):
             )
         return new_x
 
-    def fill_zero(self, X, pad_len=0, mode='righthand'):
+    def fill_zero(self, X, pad_len=0, mode='righthand', out=None):
         """
         Given variable lengths sequences,
         pad zeros w.r.t to the maximum
@@ -180,37 +306,55 @@ class SequentialPrepMixin(object):
             'lefthand' : pad the zeros at the left space
             'random'   : pad the zeros with randomly
                          chosen left space and right space
+        out     : ndArray, optional C-contiguous buffer for the padded
+                  sequences, of as many values as the result
         """
+        values, offsets, kind = _unpack(X)
+        dtype = _float_dtype(values.dtype)
+        if offsets is None:
+            if pad_len == 0:
+                return values
+            pad = {'lefthand': (pad_len, 0), 'righthand': (0, pad_len),
+                   'random': (pad_len, pad_len)}[mode]
+            widths = [(0, 0), pad] + [(0, 0)] * (values.ndim - 2)
+            return np.pad(values, widths, mode='constant').astype(dtype, copy=False)
+
+        lengths = np.diff(offsets)
         if pad_len == 0:
-            X_max = np.array([len(x) for x in X]).max()
-            new_X = np.zeros((len(X), X_max))
-            for i, x in enumerate(X):
-                free_ = X_max - len(x)
-                if mode == 'lefthand':
-                    new_x = np.concatenate([np.zeros((free_)), x], axis=1)
-                elif mode == 'righthand':
-                    new_x = np.concatenate([x, np.zeros((free_))], axis=1)
-                elif mode == 'random':
-                    j = np.random.randint(free_)
-                    new_x = np.concatenate(
-                        [np.zeros((j)), x, np.zeros((free_ - j))],
-                        axis=1
-                    )
-                new_X[i] = new_x
+            X_max = lengths.max()
+            free_ = X_max - lengths
+            new_lengths = np.zeros_like(lengths) + X_max
         else:
-            new_X = []
-            for x in X:
-                if mode == 'lefthand':
-                    new_x = np.concatenate([np.zeros((pad_len)), x], axis=1)
-                elif mode == 'righthand':
-                    new_x = np.concatenate([x, np.zeros((pad_len))], axis=1)
-                elif mode == 'random':
-                    new_x = np.concatenate(
-                        [np.zeros((pad_len)), x, np.zeros((pad_len))],
-                         axis=1
-                    )
-                new_X.append(new_x)
-        return new_X
+            free_ = np.zeros_like(lengths) + pad_len
+            new_lengths = lengths + pad_len * (2 if mode == 'random' else 1)
+        if mode == 'lefthand':
+            lead = free_
+        elif mode == 'righthand':
+            lead = np.zeros_like(lengths)
+        elif mode == 'random' and pad_len:
+            lead = free_
+        elif mode == 'random':
+            # one draw per sequence, in order, as when padding one at a time
+            lead = np.array([np.random.randint(f) if f else 0 for f in free_],
+                            dtype='int64')
+
+        # scatter every sequence after its leading zeros
+        new_offsets = np.concatenate([[0], np.cumsum(new_lengths)]).astype('int64')
+        if out is None:
+            out = np.zeros(new_offsets[-1], dtype=dtype)
+        else:
+            # reshaping a non-contiguous buffer would fill a copy of it
+            if not out.flags.c_contiguous or out.size != new_offsets[-1]:
+                raise ValueError("out must be a C-contiguous array of %d values"
+                                 % new_offsets[-1])
+            out = out.reshape(-1)
+            out[...] = 0
+        seq = np.repeat(np.arange(len(lengths)), lengths)
+        pos = np.arange(len(values)) - offsets[:-1][seq]
+        out[new_offsets[:-1][seq] + lead[seq] + pos] = values
+        if pad_len == 0:
+            return out.reshape(len(lengths), X_max)
+        return _pack(out, new_offsets, kind)
 
     def reverse(self, X):
         """
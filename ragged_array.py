@@ -0,0 +1,40 @@
+import numpy as np
+
+
+class RaggedArray(object):
+    '''
+    Sequences of varying lengths stored as one flat token array, sequence i
+    being tokens[offsets[i]:offsets[i + 1]].
+    '''
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = np.asarray(offsets)
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def pad(self, indices, pad_id=0, bos_id=None, eos_id=None):
+        '''
+        Gather the sequences at `indices` into a dense batch padded with
+        `pad_id`, each sequence being optionally framed by `bos_id` and
+        `eos_id`.
+        '''
+        indices = np.asarray(indices)
+        starts = self.offsets[indices]
+        lengths = self.lengths[indices]
+        lead = int(bos_id is not None)
+        max_len = lengths.max()
+
+        batch = np.empty((len(indices), max_len + lead + int(eos_id is not None)), dtype=int)
+        batch.fill(pad_id)
+        rows, cols = np.nonzero(np.arange(max_len)[None, :] < lengths[:, None])
+        batch[rows, cols + lead] = self.tokens[starts[rows] + cols]
+        if bos_id is not None:
+            batch[:, 0] = bos_id
+        if eos_id is not None:
+            batch[np.arange(len(indices)), lengths + lead] = eos_id
+        return batch
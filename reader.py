@@ -3,11 +3,15 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import hashlib
 import os
 
 import numpy as np
 import cPickle as pkl
 
+PTB_DICTIONARY = '/data/lisatmp4/anirudhg/ptb/ptb_dict_word.pkl'
+
+
 def _read_words(filename):
     with open(filename, "r") as f:
         return f.read().replace("\n", "<eos>").split()
@@ -25,48 +29,88 @@ def _build_vocab(filename):
     return word_to_id
 
 
-def _file_to_word_ids(filename, word_to_id):
-    data = _read_words(filename)
-    ss = [word_to_id[w] if w in word_to_id else 1  for w in data]
-    return ss#[word_to_id[word] for word in data]
+def _words_to_ids(words, vocab, vocab_ids):
+    """Map words to ids in one pass over the unique words, unknown -> 1.
+    `vocab` is the sorted array of known words, `vocab_ids` their ids."""
+    if not words:
+        return np.zeros(0, dtype=np.int32)
+    words, inverse = np.unique(np.array(words), return_inverse=True)
+    pos = np.minimum(np.searchsorted(vocab, words), len(vocab) - 1)
+    ids = np.where(vocab[pos] == words, vocab_ids[pos], 1)
+    return ids[inverse].astype(np.int32)
+
 
+def _cache_key(paths):
+    """Hash of the contents of `paths`."""
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()[:16]
 
-def ptb_raw_data(data_path=None):
+
+def ptb_raw_data(data_path=None, dictionary=PTB_DICTIONARY, cache_dir=None):
     """Load PTB raw data from data directory "data_path".
     Reads PTB text files, converts strings to integer ids,
     and performs mini-batching of the inputs.
     The PTB dataset comes from Tomas Mikolov's webpage:
     http://www.fit.vutbr.cz/~imikolov/rnnlm/simple-examples.tgz
+    The id arrays are cached in "cache_dir" (default: data_path) under a
+    hash of the three text files and the dictionary, so later runs skip
+    the text processing.
     Args:
       data_path: string path to the directory where simple-examples.tgz has
         been extracted.
+      dictionary: path of the pickled word -> id dictionary.
+      cache_dir: directory of the cached id arrays.
     Returns:
       tuple (train_data, valid_data, test_data, vocabulary)
-      where each of the data objects can be passed to PTBIterator.
+      where each of the data objects is an int32 array that can be passed
+      to ptb_iterator.
     """
     train_path = os.path.join(data_path, "ptb.train.txt")
     valid_path = os.path.join(data_path, "ptb.valid.txt")
     test_path = os.path.join(data_path, "ptb.test.txt")
 
-    dictionary = '/data/lisatmp4/anirudhg/ptb/ptb_dict_word.pkl'
+    paths = [train_path, valid_path, test_path, dictionary]
+    cache_path = os.path.join(cache_dir or data_path,
+                              "ptb_ids_%s.npz" % _cache_key(paths))
+    if os.path.isfile(cache_path):
+        cached = np.load(cache_path)
+        return (cached["train"], cached["valid"], cached["test"],
+                int(cached["vocabulary"]))
+
     with open(dictionary, 'rb') as f:
         worddicts = pkl.load(f)
     word_to_id = worddicts#_build_vocab(train_path)
-    train_data = _file_to_word_ids(train_path, word_to_id)
-    valid_data = _file_to_word_ids(valid_path, word_to_id)
-    test_data = _file_to_word_ids(test_path, word_to_id)
+    vocab = np.array(sorted(word_to_id))
+    vocab_ids = np.array([word_to_id[w] for w in vocab], dtype=np.int32)
+    train_data = _words_to_ids(_read_words(train_path), vocab, vocab_ids)
+    valid_data = _words_to_ids(_read_words(valid_path), vocab, vocab_ids)
+    test_data = _words_to_ids(_read_words(test_path), vocab, vocab_ids)
     vocabulary = len(word_to_id)
+
+    # write then rename, so that concurrent runs never read a partial file
+    tmp_path = cache_path + ".tmp.npz"
+    np.savez(tmp_path, train=train_data, valid=valid_data, test=test_data,
+             vocabulary=vocabulary)
+    os.rename(tmp_path, cache_path)
     return train_data, valid_data, test_data, vocabulary
 
 
-def ptb_iterator(raw_data, batch_size, num_steps):
+def ptb_iterator(raw_data, batch_size, num_steps, contiguous=False):
     """Iterate on the raw PTB data.
     This generates batch_size pointers into the raw PTB data, and allows
-    minibatch iteration along these pointers.
+    minibatch iteration along these pointers. Row i of every batch
+    continues row i of the previous one, so the recurrent state can be
+    carried across batches for truncated BPTT.
     Args:
       raw_data: one of the raw data outputs from ptb_raw_data.
       batch_size: int, the batch size.
       num_steps: int, the number of unrolls.
+      contiguous: bool, yield C-contiguous copies of each segment instead
+        of strided views into raw_data.
     Yields:
       Pairs of the batched data, each a matrix of shape [batch_size, num_steps].
       The second element of the tuple is the same data time-shifted to the
@@ -74,12 +118,11 @@ def ptb_iterator(raw_data, batch_size, num_steps):
     Raises:
       ValueError: if batch_size or num_steps are too high.
     """
-    raw_data = np.array(raw_data, dtype=np.int32)
+    raw_data = np.asarray(raw_data, dtype=np.int32)
     data_len = len(raw_data)
     batch_len = data_len // batch_size
-    data = np.zeros([batch_size, batch_len], dtype=np.int32)
-    for i in range(batch_size):
-        data[i] = raw_data[batch_len * i:batch_len * (i + 1)]
+    # a single reshape of the truncated array, no copy
+    data = raw_data[:batch_size * batch_len].reshape(batch_size, batch_len)
 
     epoch_size = (batch_len - 1) // num_steps
 
@@ -89,4 +132,6 @@ def ptb_iterator(raw_data, batch_size, num_steps):
     for i in range(epoch_size):
         x = data[:, i * num_steps:(i + 1) * num_steps]
         y = data[:, i * num_steps + 1:(i + 1) * num_steps + 1]
+        if contiguous:
+            x, y = np.ascontiguousarray(x), np.ascontiguousarray(y)
         yield (x, y)
@@ -1,29 +1,191 @@
 #import ipdb
+import ctypes
+import traceback
 import numpy as np
 
 from multiprocessing import Process, Queue
+from multiprocessing.sharedctypes import RawArray
+
+
 class Data(object):
     """
     Abstract class for data
     Parameters
     ----------
     .. todo::
+    Notes
+    -----
+    `row_axis` is the axis of the rows in the arrays returned by
+    `slices`.
+    With multi_process > 0, `iter_slices` computes `slices` in that many
+    worker processes. Workers are forked when the iteration starts and
+    stopped once it ends or the generator is closed. Each calls
+    `worker_init` (e.g. to reopen files) and writes its batches into
+    shared-memory slots that the consumer copies out of.
     """
+    row_axis = 0
+
     def __init__(self, name=None, path=None, multi_process=0):
         self.name = name
         self.data = self.load(path)
         self.multi_process = multi_process
-        if multi_process > 0:
-            self.queue = Queue(2**15)
-            processes = [None] * multi_process
-            for mid in xrange(multi_process):
-                processes[mid] = Process(target=self.multi_process_slices,
-                                         args=(mid,))
-                processes[mid].start()
+        self.processes = []
+
+    def start_workers(self, slot_bytes, n_slots=None):
+        """
+        Fork the worker processes
+        Parameters
+        ----------
+        slot_bytes : integer
+            Size of a shared-memory slot, larger batches go through the
+            result queue instead
+        n_slots    : integer
+            Number of batches in flight, 2 per worker by default
+        """
+        self.stop_workers()
+        n_slots = n_slots or 2 * self.multi_process
+        self._slot_bytes = slot_bytes
+        self._slots = [np.ctypeslib.as_array(RawArray(ctypes.c_uint8, slot_bytes))
+                       for i in xrange(n_slots)]
+        self._tasks = Queue()
+        self._results = Queue()
+        self.processes = [Process(target=self.multi_process_slices, args=(mid,))
+                          for mid in xrange(self.multi_process)]
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+
+    def stop_workers(self):
+        for process in self.processes:
+            self._tasks.put(None)
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def worker_init(self):
+        """ Called once in every worker before its first batch. """
+        pass
 
     def multi_process_slices(self, mid=-1):
-        raise NotImplementedError(
-            str(type(self)) + " does not implement Data.multi_process_slices.")
+        self.worker_init()
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            task_id, start, end, slot = task
+            try:
+                batch = self.slices(start, end)
+                batch = (batch,) if isinstance(batch, np.ndarray) else tuple(batch)
+                self._results.put((task_id, slot, self._pack(batch, slot)))
+            except Exception:
+                self._results.put((task_id, slot, traceback.format_exc()))
+
+    def _pack(self, batch, slot):
+        """ Write `batch` into a slot, or return it if it does not fit. """
+        batch = [np.ascontiguousarray(x) for x in batch]
+        offsets = np.cumsum([0] + [-(-x.nbytes // 16) * 16 for x in batch])
+        if offsets[-1] > self._slot_bytes:
+            return batch
+        buf = self._slots[slot]
+        layout = []
+        for x, offset in zip(batch, offsets):
+            buf[offset:offset + x.nbytes] = x.reshape(-1).view(np.uint8)
+            layout.append((x.dtype.str, x.shape, offset))
+        return layout
+
+    def _unpack(self, slot, layout):
+        buf = self._slots[slot]
+        batch = []
+        for dtype, shape, offset in layout:
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            batch.append(buf[offset:offset + nbytes].view(dtype).reshape(shape).copy())
+        return tuple(batch)
+
+    def iter_slices(self, ranges, ordered=True):
+        """
+        Yield `slices(start, end)` for every (start, end) of `ranges`
+        Parameters
+        ----------
+        ranges  : iterable of (start, end) tuples, consumed lazily
+        ordered : bool
+            Yield batches in the order of `ranges`, else as they are ready
+        Notes
+        -----
+        Batches are tuples of arrays. Without workers the batches are
+        computed here. Workers forked by this call are stopped when it
+        returns, raises or is closed.
+        """
+        if self.multi_process <= 0:
+            for start, end in ranges:
+                yield self.slices(start, end)
+            return
+
+        ranges = iter(ranges)
+        in_flight = {}
+        done = {}
+        n_sent = 0
+        n_received = 0
+        n_yielded = 0
+        started = not self.processes
+        if started:
+            # size the slots after the first batch, computed here
+            try:
+                start, end = next(ranges)
+            except StopIteration:
+                return
+            first = self.slices(start, end)
+            first = (first,) if isinstance(first, np.ndarray) else tuple(first)
+            self.start_workers(2 * sum(x.nbytes + 16 for x in first))
+            done[0] = first
+            n_sent = n_received = 1
+
+        free = range(len(self._slots))
+        exhausted = False
+        try:
+            while True:
+                if ordered:
+                    while n_yielded in done:
+                        yield done.pop(n_yielded)
+                        n_yielded += 1
+                else:
+                    for task_id in done.keys():
+                        yield done.pop(task_id)
+                        n_yielded += 1
+
+                # ranges are drawn lazily, they may come from an endless sampler
+                while free and not exhausted:
+                    try:
+                        start, end = next(ranges)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    in_flight[n_sent] = (start, end)
+                    self._tasks.put((n_sent, start, end, free.pop()))
+                    n_sent += 1
+                if n_received == n_sent:
+                    break
+
+                task_id, slot, layout = self._results.get()
+                n_received += 1
+                if isinstance(layout, str):
+                    free.append(slot)
+                    raise RuntimeError("Worker failed on slices%s:\n%s"
+                                       % (in_flight.pop(task_id), layout))
+                in_flight.pop(task_id)
+                if layout and isinstance(layout[0], np.ndarray):
+                    # did not fit in the slot, sent through the queue
+                    done[task_id] = tuple(layout)
+                else:
+                    done[task_id] = self._unpack(slot, layout)
+                free.append(slot)
+        finally:
+            # wait for the batches in flight so that the slots are free again
+            for i in xrange(n_sent - n_received):
+                self._results.get()
+            if started:
+                self.stop_workers()
 
     def load(self, path):
         return np.load(path)
@@ -33,6 +195,9 @@ class Data(object):
             str(type(self)) + " does not implement Data.slices.")
 
     def num_examples(self):
+        if hasattr(self.data, 'shape'):
+            # a single array, e.g. an HDF5 EArray, not to be read row by row
+            return self.data.shape[0]
         return max(mat.shape[0] for mat in self.data)
 
     def theano_vars(self):
@@ -49,40 +214,87 @@ class TemporalSeries(Data):
     ----------
     .. todo::
     """
+    # slices are time-major, rows along the second axis
+    row_axis = 1
+
     def slices(self, start, end):
         return (mat[start:end].swapaxes(0, 1)
                 for mat in self.data)
 
-    def create_mask(self, batch):
-        samples_len = [len(sample) for sample in batch]
-        max_sample_len = max(samples_len)
-        mask = np.zeros((max_sample_len, len(batch)), dtype=batch[0].dtype)
-        for i, sample_len in enumerate(samples_len):
-            mask[:sample_len, i] = 1.
+    # keep the padded outputs between calls instead of allocating new ones,
+    # only safe when a batch is consumed before the next one is packed
+    reuse_buffers = False
+
+    def _buffer(self, name, shape, dtype):
+        """ Zeroed array of `shape`, reusing the previous one if allowed. """
+        size = int(np.prod(shape))
+        buffers = self.__dict__.setdefault('_pad_buffers', {})
+        buf = buffers.get(name)
+        if not self.reuse_buffers or buf is None or buf.dtype != dtype or buf.size < size:
+            buf = np.zeros(max(size, 1), dtype=dtype)
+            if self.reuse_buffers:
+                buffers[name] = buf
+        else:
+            buf[:size] = 0
+        return buf[:size].reshape(shape)
+
+    def _ragged(self, batch, lengths=None):
+        """ Flat values and lengths of a list of samples. """
+        if lengths is None:
+            lengths = np.array([len(sample) for sample in batch], dtype='int64')
+            values = np.concatenate([np.asarray(sample) for sample in batch])
+        else:
+            lengths = np.asarray(lengths, dtype='int64')
+            values = np.asarray(batch)
+        return values, lengths
+
+    def _mask(self, lengths, dtype, time_major=True):
+        max_sample_len = lengths.max()
+        shape = (max_sample_len, len(lengths)) if time_major else \
+            (len(lengths), max_sample_len)
+        mask = self._buffer('mask', shape, dtype)
+        steps = np.arange(max_sample_len)
+        if time_major:
+            mask[...] = steps[:, None] < lengths[None, :]
+        else:
+            mask[...] = steps[None, :] < lengths[:, None]
         return mask
 
-    def zero_pad(self, batch):
-        max_sample_len = max(len(sample) for sample in batch)
-        rval = np.zeros((len(batch), max_sample_len, batch[0].shape[-1]),
-                        dtype=batch[0].dtype)
-        for i, sample in enumerate(batch):
-            rval[i, :len(sample)] = sample
-        return rval.swapaxes(0, 1)
+    def pack(self, batch, lengths=None, time_major=True):
+        """
+        Zero pad a ragged batch and build its mask
+        Parameters
+        ----------
+        batch      : list of ndArrays, or the flat concatenation of the samples
+        lengths    : list of integers
+            Lengths of the samples when `batch` is flat
+        time_major : bool
+            Return (max_len, n_samples, ...) arrays, else (n_samples, max_len, ...)
+        Returns
+        -------
+        rval : padded samples
+        mask : (max_len, n_samples) or (n_samples, max_len), dtype of the samples
+        """
+        values, lengths = self._ragged(batch, lengths)
+        mask = self._mask(lengths, values.dtype, time_major)
+        shape = mask.shape + values.shape[1:]
+        rval = self._buffer('rval', shape, values.dtype)
 
-    def create_mask_and_zero_pad(self, batch):
-        samples_len = [len(sample) for sample in batch]
-        max_sample_len = max(samples_len)
-        mask = np.zeros((max_sample_len, len(batch)), dtype=batch[0].dtype)
-        if batch[0].ndim == 1:
-            rval = np.zeros((max_sample_len, len(batch)), dtype=batch[0].dtype)
+        # scatter every sample in one go
+        sample = np.repeat(np.arange(len(lengths)), lengths)
+        step = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        if time_major:
+            rval[step, sample] = values
         else:
-            rval = np.zeros((max_sample_len, len(batch), batch[0].shape[1]),
-                            dtype=batch[0].dtype)
-        for i, (sample, sample_len) in enumerate(zip(batch, samples_len)):
-            mask[:sample_len, i] = 1.
-            if batch[0].ndim == 1:
-                rval[:sample_len, i] = sample
-            else:
-                rval[:sample_len, i, :] = sample
+            rval[sample, step] = values
         return rval, mask
 
+    def create_mask(self, batch):
+        lengths = np.array([len(sample) for sample in batch], dtype='int64')
+        return self._mask(lengths, batch[0].dtype)
+
+    def zero_pad(self, batch):
+        return self.pack(batch)[0]
+
+    def create_mask_and_zero_pad(self, batch):
+        return self.pack(batch)
@@ -31,7 +31,9 @@ def main(job_id, params):
         dictionary=None,
         dropout=params['dropout'],
         kl_start=params['kl_start'],
-        kl_rate=0.0001)
+        kl_rate=0.0001,
+        bucketed=params['bucketed'],
+        synthetic=params['synthetic'])
     return validerr
 
 
@@ -47,6 +49,8 @@ if __name__ == '__main__':
     parser.add_argument('--use_h_in_aux', action='store_true')
     parser.add_argument('--num_nf_layers', type=int, default=0)
     parser.add_argument('--dropout', type=float, default=0.2)
+    parser.add_argument('--bucketed', action='store_true', help='batch sentences of similar lengths together')
+    parser.add_argument('--synthetic', action='store_true', help='train on random token sequences instead of the reviews')
     args = parser.parse_args()
 
     main(0, {
@@ -57,6 +61,8 @@ if __name__ == '__main__':
         'num_nf_layers': args.num_nf_layers,
         'weight_aux': args.weight_aux,
         'use_h_in_aux': args.use_h_in_aux,
+        'bucketed': args.bucketed,
+        'synthetic': args.synthetic,
         'dim_input': -1,
         'dim': 500,
         'dim_proj': 300,
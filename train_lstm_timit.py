@@ -24,7 +24,8 @@ def main(job_id, params):
         dictionary=None,
         use_dropout=params['use-dropout'][0],
         kl_start=0.2,
-        kl_rate=0.00005)
+        kl_rate=0.00005,
+        synthetic=params['synthetic'][0])
     return validerr
 
 if __name__ == '__main__':
@@ -43,4 +44,5 @@ if __name__ == '__main__':
         'decay-c': [0.],
         'use-dropout': [False],
         'learning-rate': [0.001],
+        'synthetic': [False],
         'reload': [False]})
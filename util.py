@@ -1,3 +1,4 @@
+import itertools
 import numpy as np
 import os
 import theano
@@ -28,45 +29,85 @@ class Iterator(object):
     Dataset iterator
     Parameters
     ----------
-    .. todo::
+    data          : Data
+    batch_size    : integer
+    nbatch        : integer, number of batches, instead of batch_size
+    start         : integer, first row
+    end           : integer, last row (excluded)
+    shuffle       : bool
+        Visit the batches in a new order every epoch, by row blocks when
+        `data` has `batch_starts`
+    infinite_data : bool
+        Draw `pseudo_n` batches from endless shuffled passes over the rows
+    rng           : numpy.random.RandomState
+    Notes
+    -----
+    Batches are [x, y] with y the rows following those of x. Both are read
+    at once as batch_size + 1 rows and are overlapping views of it.
     """
     def __init__(self, data, batch_size=None, nbatch=None,
                  start=0, end=None, shuffle=False, infinite_data=0,
-                 pseudo_n=1000000):
+                 pseudo_n=1000000, rng=np.random):
         if (batch_size or nbatch) is None:
             raise ValueError("Either batch_size or nbatch should be given.")
         if (batch_size and nbatch) is not None:
             raise ValueError("Provide either batch_size or nbatch.")
         self.infinite_data = infinite_data
-        if not infinite_data:
-            self.start = start
-            self.end = data.num_examples() if end is None else end
-            if self.start >= self.end or self.start < 0:
-                raise ValueError("Got wrong value for start %d." % self.start)
-            self.nexp = self.end - self.start
-            if nbatch is not None:
-                self.batch_size = int(np.float(self.nexp / float(nbatch)))
-                self.nbatch = nbatch
-            elif batch_size is not None:
-                self.batch_size = batch_size
-                self.nbatch = int(np.float(self.nexp / float(batch_size)))
-            self.shuffle = shuffle
-        else:
-            self.pseudo_n = pseudo_n
+        self.pseudo_n = pseudo_n
+        self.start = start
+        self.n_rows = data.num_examples()
+        self.end = self.n_rows if end is None else end
+        if self.start >= self.end or self.start < 0:
+            raise ValueError("Got wrong value for start %d." % self.start)
+        self.nexp = self.end - self.start
+        if nbatch is not None:
+            self.batch_size = int(np.float(self.nexp / float(nbatch)))
+            self.nbatch = nbatch
+        elif batch_size is not None:
+            self.batch_size = batch_size
+            self.nbatch = int(np.float(self.nexp / float(batch_size)))
+        self.shuffle = shuffle
+        self.rng = rng
         self.data = data
         self.name = self.data.name
 
+    def batch_starts(self, shuffle=False):
+        """ First rows of the batches of one pass over the rows. """
+        # the row after the batch, first of the targets, must exist
+        end = min(self.end - self.end % self.batch_size, self.n_rows - self.batch_size)
+        if not shuffle:
+            return np.arange(self.start, end, self.batch_size)
+        if hasattr(self.data, 'batch_starts'):
+            return self.data.batch_starts(self.batch_size, self.start, end, self.rng)
+        return self.rng.permutation(np.arange(self.start, end, self.batch_size))
+
+    def _endless_starts(self):
+        while True:
+            starts = self.batch_starts(shuffle=True)
+            if len(starts) == 0:
+                raise ValueError("No complete batch of %d rows." % self.batch_size)
+            for idx in starts:
+                yield idx
+
     def __iter__(self):
         if self.infinite_data:
-            for i in xrange(self.pseudo_n):
-                yield self.data.slices()
+            starts = itertools.islice(self._endless_starts(), self.pseudo_n)
         else:
-            if self.shuffle:
-                self.data.shuffle()
-            start = self.start
-            end = self.end - self.end % self.batch_size
-            for idx in xrange(start, end, self.batch_size):
-                yield [self.data.slices(idx, idx + self.batch_size), self.data.slices(idx + 1, idx + self.batch_size +1)]
+            starts = self.batch_starts(self.shuffle)
+        ranges = ((idx, idx + self.batch_size + 1) for idx in starts)
+        if getattr(self.data, 'multi_process', 0) > 0:
+            # rows read in the worker processes
+            batches = self.data.iter_slices(ranges)
+        else:
+            batches = (self.data.slices(idx, end) for idx, end in ranges)
+
+        axis = getattr(self.data, 'row_axis', 0)
+        x_rows = (slice(None),) * axis + (slice(None, -1),)
+        y_rows = (slice(None),) * axis + (slice(1, None),)
+        for batch in batches:
+            batch = totuple(batch) if isinstance(batch, np.ndarray) else tuple(batch)
+            yield [tuple(mat[x_rows] for mat in batch),
+                   tuple(mat[y_rows] for mat in batch)]
 
 
 def complex_to_real(X):
@@ -77,14 +118,11 @@ def complex_to_real(X):
     X : list of complex vectors
     Notes
     -----
-    This function assumes X as 2D
+    Real and imaginary parts are concatenated along the last axis,
+    X can have any number of leading dimensions.
     """
-    new_X = []
-    for i in xrange(len(X)):
-        x = X[i]
-        new_x = np.concatenate([np.real(x), np.imag(x)])
-        new_X.append(new_x)
-    return np.array(new_X)
+    X = np.asarray(X)
+    return np.concatenate([np.real(X), np.imag(X)], axis=-1)
 
 
 def floatX(num):
@@ -102,8 +140,11 @@ def upscale_images(X, LEVEL):
     X = numpy.uint8(X*LEVEL)
     return X
 
-def stochastic_binarize(X):
-    return (numpy.random.uniform(size=X.shape) < X).astype('float32')
+def stochastic_binarize(X, out=None, rng=numpy.random):
+    """ Sample X > U(0, 1) into `out`, float32 by default, X may be `out`. """
+    if out is None:
+        out = numpy.empty(X.shape, dtype='float32')
+    return numpy.less(rng.uniform(size=X.shape), X, out=out)
 
 def sample_from_softmax(softmax_var):
     #softmax_var assumed to be of shape (batch_size, num_classes)
@@ -242,10 +283,6 @@ def unzip(zipped):
         new_params[kk] = vv.get_value()
     return new_params
 
-from fuel.datasets import SVHN
-from fuel.schemes import ShuffledScheme
-from fuel.streams import DataStream
-
 def create_streams(train_set, valid_set, test_set, training_batch_size,
                    monitoring_batch_size):
     """Creates data streams for training and monitoring.
@@ -268,6 +305,9 @@ def create_streams(train_set, valid_set, test_set, training_batch_size,
         Data streams for the main loop, the training set monitor,
         the validation set monitor and the test set monitor.
     """
+    from fuel.schemes import ShuffledScheme
+    from fuel.streams import DataStream
+
     main_loop_stream = DataStream.default_stream(
         dataset=train_set,
         iteration_scheme=ShuffledScheme(
@@ -303,6 +343,8 @@ def create_svhn_streams(training_batch_size, monitoring_batch_size):
         Data streams for the main loop, the training set monitor,
         the validation set monitor and the test set monitor.
     """
+    from fuel.datasets import SVHN
+
     train_set = SVHN(2, ('train',), sources=('features',),
                      subset=slice(0, 63257))
     valid_set = SVHN(2, ('train',), sources=('features',),
@@ -312,17 +354,216 @@ def create_svhn_streams(training_batch_size, monitoring_batch_size):
     return create_streams(train_set, valid_set, test_set, training_batch_size,
                           monitoring_batch_size)
 
+class GaussianMixture(object):
+    """
+    Samples of a mixture of Gaussians, generated in memory
+    Parameters
+    ----------
+    num_examples : integer
+    means        : (n_components, dim) array
+        A 5x5 grid over [-4, 4]^2 by default
+    variances    : (n_components, dim, dim) covariances, or
+        (n_components,) variances of isotropic components, 0.01 by default
+    priors       : (n_components,) weights, uniform by default
+    rng          : numpy.random.RandomState
+    seed         : integer, used when rng is None
+    batch_size   : integer
+    Notes
+    -----
+    `features`, `label` and `density` hold the samples, the component that
+    drew them and the density of the mixture at them. get_train_batch and
+    get_valid_batch yield (features, label) batches, of the samples and of
+    a second draw of `num_examples` samples.
+    """
+    def __init__(self, num_examples=100000, means=None, variances=None,
+                 priors=None, rng=None, seed=1234, batch_size=100):
+        if means is None:
+            grid = np.linspace(-4, 4, 5)
+            means = np.dstack(np.meshgrid(grid, grid)).reshape(-1, 2)
+        self.means = np.asarray(means, dtype='float64')
+        n_components, dim = self.means.shape
+        if variances is None:
+            variances = np.zeros(n_components) + 0.01
+        variances = np.asarray(variances, dtype='float64')
+        if variances.ndim == 1:
+            variances = variances[:, None, None] * np.eye(dim)
+        self.variances = variances
+        if priors is None:
+            priors = np.ones(n_components)
+        self.priors = np.asarray(priors, dtype='float64') / np.sum(priors)
+        self.rng = np.random.RandomState(seed) if rng is None else rng
+        self.batch_size = batch_size
+        self.num_examples = num_examples
+
+        self._chol = np.linalg.cholesky(self.variances)
+        self._inv_chol = np.linalg.inv(self._chol)
+        self._log_norm = (-0.5 * dim * np.log(2 * np.pi) -
+                          np.log(np.diagonal(self._chol, axis1=1, axis2=2)).sum(axis=1))
+
+        self.features, self.label = self.sample(num_examples)
+        self.density = self.pdf(self.features)
+        self._valid = self.sample(num_examples)
+
+    def sample(self, n, rng=None):
+        """ Draw n samples and the components they come from. """
+        rng = self.rng if rng is None else rng
+        label = rng.choice(len(self.priors), size=n, p=self.priors)
+        z = rng.standard_normal((n, self.means.shape[1]))
+        features = self.means[label] + np.einsum('nij,nj->ni', self._chol[label], z)
+        return features.astype(theano.config.floatX), label
+
+    def pdf(self, x):
+        """ Density of the mixture at the rows of x. """
+        diff = np.asarray(x, dtype='float64')[:, None, :] - self.means[None]
+        m = np.einsum('kij,nkj->nki', self._inv_chol, diff)
+        log_p = self._log_norm - 0.5 * np.square(m).sum(axis=-1)
+        return np.exp(log_p).dot(self.priors).astype(theano.config.floatX)
+
+    def _iter_data(self, features, label, order):
+        for i in range(0, len(order), self.batch_size):
+            idx = order[i:i + self.batch_size]
+            yield features[idx], label[idx]
+
+    def get_train_batch(self):
+        order = self.rng.permutation(self.num_examples)
+        return self._iter_data(self.features, self.label, order)
+
+    def get_valid_batch(self):
+        features, label = self._valid
+        return self._iter_data(features, label, np.arange(len(features)))
+
+
+class GaussianMixtureSequences(object):
+    """
+    Sequences of frames drawn from a GaussianMixture, batched like
+    lm_data.TimitData
+    Parameters
+    ----------
+    mixture    : GaussianMixture, the default one if None
+    batch_size : integer
+    seq_len    : integer, maximum sequence length
+    min_len    : integer
+        Lengths are uniform in [min_len, seq_len], all seq_len by default
+    n_batches  : integer, batches per epoch
+    seed       : integer
+    Notes
+    -----
+    Batches are (u, x, mask), x being u shifted by one frame, of shape
+    (batch_size, seq_len, dim). Training epochs are new draws, valid and
+    test are the same draws every time. lm_lstm_timit.train(synthetic=True)
+    trains on them.
+    """
+    def __init__(self, mixture=None, batch_size=64, seq_len=40, min_len=None,
+                 n_batches=100, seed=1234):
+        self.mixture = GaussianMixture(num_examples=0) if mixture is None else mixture
+        self.dim = self.mixture.means.shape[1]
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.min_len = seq_len if min_len is None else min_len
+        self.n_batches = n_batches
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+
+    def _batch(self, rng):
+        n, length = self.batch_size, self.seq_len
+        frames, _ = self.mixture.sample(n * (length + 1), rng)
+        frames = frames.reshape(n, length + 1, -1)
+        lengths = rng.randint(self.min_len, length + 1, size=n)
+        mask = (np.arange(length)[None, :] < lengths[:, None]).astype('float32')
+        return (frames[:, :-1] * mask[:, :, None], frames[:, 1:] * mask[:, :, None], mask)
+
+    def _iter_data(self, rng):
+        for i in range(self.n_batches):
+            yield self._batch(rng)
+
+    def get_train_batch(self):
+        return self._iter_data(self.rng)
+
+    def get_valid_batch(self):
+        return self._iter_data(np.random.RandomState(self.seed + 1))
+
+    def get_test_batch(self):
+        return self._iter_data(np.random.RandomState(self.seed + 2))
+
+
+class SyntheticSequences(object):
+    """
+    Random token sequences batched like lm_data.IMDB_JMARS
+    Parameters
+    ----------
+    n_words    : integer, vocabulary size, token 0 being the padding
+    batch_size : integer
+    seq_len    : integer, maximum sequence length
+    min_len    : integer
+        Lengths are uniform in [min_len, seq_len], all seq_len by default
+    n_batches  : integer, batches per epoch
+    seed       : integer
+    Notes
+    -----
+    Batches are (x, y, m), int64 tokens of shape (batch_size, seq_len) with
+    y = x shifted by one token and m = y != 0. Training epochs are new
+    draws, valid and test are the same draws every time.
+    lm_lstm_imdb.train(synthetic=True) trains on them.
+    """
+    def __init__(self, n_words=10000, batch_size=64, seq_len=40, min_len=None,
+                 n_batches=100, seed=1234):
+        self.voc_size = n_words
+        self.pad_id = 0
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.min_len = seq_len if min_len is None else min_len
+        self.n_batches = n_batches
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        # Fraction of padded steps in the training batches of the last epoch
+        self.padding_ratio = None
+
+    def _batch(self, rng):
+        n, length = self.batch_size, self.seq_len
+        batch = rng.randint(1, self.voc_size, size=(n, length + 1)).astype('int64')
+        lengths = rng.randint(self.min_len, length + 1, size=n)
+        batch[np.arange(length + 1)[None, :] > lengths[:, None]] = self.pad_id
+        x = batch[:, :-1]
+        y = batch[:, 1:]
+        m = np.not_equal(y, self.pad_id).astype('float32')
+        return x, y, m
+
+    def _iter_data(self, rng):
+        for i in range(self.n_batches):
+            yield self._batch(rng)
+
+    def get_train_batch(self):
+        n_steps, n_padded = 0, 0
+        for x, y, m in self._iter_data(self.rng):
+            n_steps += m.size
+            n_padded += m.size - m.sum()
+            self.padding_ratio = n_padded / float(n_steps)
+            yield x, y, m
+
+    def get_valid_batch(self):
+        return self._iter_data(np.random.RandomState(self.seed + 1))
+
+    def get_test_batch(self):
+        return self._iter_data(np.random.RandomState(self.seed + 2))
+
+
 def create_gaussian_mixture_data_streams(batch_size, monitoring_batch_size,
                                          means=None, variances=None, priors=None,
                                          rng=None, num_examples=100000,
                                          sources=('features', )):
-    train_set = GaussianMixture(num_examples=num_examples, means=means,
-                                variances=variances, priors=priors,
-                                rng=rng, sources=sources)
-
-    valid_set = GaussianMixture(num_examples=num_examples,
-                                means=means, variances=variances,
-                                priors=priors, rng=rng, sources=sources)
+    from fuel.datasets import IndexableDataset
+    from fuel.schemes import ShuffledScheme
+    from fuel.streams import DataStream
+
+    def mixture_dataset(seed):
+        mixture = GaussianMixture(num_examples=num_examples, means=means,
+                                  variances=variances, priors=priors,
+                                  rng=rng, seed=seed)
+        return IndexableDataset(OrderedDict(
+            (source, getattr(mixture, source)) for source in sources))
+
+    train_set = mixture_dataset(1234)
+    valid_set = mixture_dataset(1235)
 
     main_loop_stream = DataStream(
         train_set,